@@ -0,0 +1,241 @@
+# Approximate nearest-neighbour index over the 128D gallery
+#
+# An inverted-file (IVF) index in pure NumPy: k-means splits the embedding
+# space into n_lists cells, every vector is filed under its nearest centroid,
+# and a query only scans the vectors of its n_probe closest cells. Inserts
+# file new vectors under the existing centroids and deletes drop them from
+# their cell, so the index follows the gallery without retraining; rebuild()
+# re-runs k-means once the gallery has grown well past the training set.
+#
+# The index does not copy the vectors. It is attached to a backing matrix
+# (the gallery memmap, shared by every worker process) and its labels; keys
+# are row numbers of that matrix, and the index only stores the cell of
+# every row. A query gathers the rows of its cells from the matrix.
+#
+# Small galleries (fewer than MIN_TRAIN vectors) are served by one cell,
+# which is an exact scan.
+
+import threading
+import logging
+import numpy as np
+
+#  Below this many vectors the index stays a single exact cell
+MIN_TRAIN = 1024
+#  Cells scanned per query
+N_PROBE = 8
+#  Retrain once the index holds this many times its training size
+RETRAIN_GROWTH = 4
+#  Rows gathered from the backing matrix at a time when filing vectors
+CHUNK = 65536
+
+
+class IVFIndex():
+
+    def __init__(self, dim=128, n_lists=None, n_probe=N_PROBE):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = np.zeros((1, dim), dtype=np.float32)
+        self.trained_size = 0
+
+        # Backing rows and their labels (user ids), owned by the caller
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._labels = []
+        # Cell of every row, -1 when the row is not indexed
+        self._cell_of = np.full(0, -1, dtype=np.int32)
+        self._size = 0
+
+        # Cached array of the rows filed under every cell
+        self._list_arrays = [None]
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return 0 <= key < len(self._cell_of) and self._cell_of[key] >= 0
+
+    #  Use matrix (rows = keys) and labels from now on, e.g. a newer snapshot
+    #  of the same gallery that has more rows
+    def attach(self, matrix, labels):
+        if len(matrix) != len(labels):
+            raise ValueError("Got %d labels for %d rows" % (len(labels), len(matrix)))
+        self._matrix = matrix
+        self._labels = labels
+        if len(matrix) > len(self._cell_of):
+            cell_of = np.full(len(matrix), -1, dtype=np.int32)
+            cell_of[:len(self._cell_of)] = self._cell_of
+            self._cell_of = cell_of
+        return self
+
+    #  k-means over (a sample of) the rows keys (default: every row); resets the cells
+    def train(self, keys=None, n_iter=10, seed=0):
+        keys = np.arange(len(self._matrix)) if keys is None else np.asarray(keys, dtype=np.int64)
+        n = len(keys)
+        if n < MIN_TRAIN:
+            self.centroids = np.zeros((1, self.dim), dtype=np.float32)
+        else:
+            n_lists = self.n_lists or int(np.clip(np.sqrt(n), 16, 4096))
+            rng = np.random.default_rng(seed)
+            # Only the sample is read from the backing matrix
+            picked = np.sort(keys[rng.choice(n, size=min(n, 64 * n_lists, 200000), replace=False)])
+            sample = np.asarray(self._matrix[picked], dtype=np.float32)
+            centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+            for _ in range(n_iter):
+                assign = self._nearest_centroid(sample, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, sample)
+                counts = np.bincount(assign, minlength=n_lists).astype(np.float32)
+                # Empty cells keep their old centroid
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            self.centroids = centroids
+        self.trained_size = n
+        self._cell_of[:] = -1
+        self._size = 0
+        self._list_arrays = [None] * len(self.centroids)
+        return self
+
+    @staticmethod
+    def _nearest_centroid(vectors, centroids, chunk=CHUNK):
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            block = vectors[start:start + chunk]
+            # ||c||^2 - 2 v.c ranks the centroids like ||v - c||^2
+            assign[start:start + chunk] = np.argmin(centroid_norms[None, :] - 2.0 * (block @ centroids.T), axis=1)
+        return assign
+
+    #  File the rows keys of the backing matrix under their nearest centroid
+    def add(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(keys):
+            return
+        if keys.max() >= len(self._cell_of):
+            raise ValueError("Row %d is past the attached matrix" % keys.max())
+        self.remove(keys)
+        for start in range(0, len(keys), CHUNK):
+            chunk = keys[start:start + CHUNK]
+            cells = self._nearest_centroid(np.asarray(self._matrix[chunk], dtype=np.float32), self.centroids)
+            self._cell_of[chunk] = cells
+            for cell in np.unique(cells):
+                self._list_arrays[cell] = None
+        self._size += len(keys)
+
+    def remove(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        keys = keys[keys < len(self._cell_of)]
+        cells = self._cell_of[keys]
+        keys, cells = keys[cells >= 0], cells[cells >= 0]
+        if not len(keys):
+            return
+        self._cell_of[keys] = -1
+        self._size -= len(keys)
+        for cell in np.unique(cells):
+            self._list_arrays[cell] = None
+
+    def _cell_rows(self, cell):
+        rows = self._list_arrays[cell]
+        if rows is None:
+            rows = np.flatnonzero(self._cell_of == cell)
+            self._list_arrays[cell] = rows
+        return rows
+
+    #  Top-k (label, distance) pairs per probe, nearest first; same shape of
+    #  result as matcher.GalleryMatcher.search
+    def search(self, probes, k=1, n_probe=None):
+        probes = np.asarray(probes, dtype=np.float32)
+        single = probes.ndim == 1
+        probes = np.atleast_2d(probes)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+
+        centroid_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        cell_scores = centroid_norms[None, :] - 2.0 * (probes @ self.centroids.T)
+        if n_probe < len(self.centroids):
+            cells = np.argpartition(cell_scores, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            cells = np.tile(np.arange(len(self.centroids)), (len(probes), 1))
+
+        results = []
+        for probe, probe_cells in zip(probes, cells):
+            rows = np.sort(np.concatenate([self._cell_rows(cell) for cell in probe_cells]))
+            if not len(rows):
+                results.append([])
+                continue
+            vectors = np.asarray(self._matrix[rows], dtype=np.float32)
+            d2 = np.einsum("ij,ij->i", vectors, vectors) + probe @ probe - 2.0 * (vectors @ probe)
+            # A row tombstoned after it was indexed reads as NaN
+            d2 = np.where(np.isfinite(d2), d2, np.inf)
+            top_k = min(k, len(rows))
+            top = np.argpartition(d2, top_k - 1)[:top_k] if top_k < len(rows) else np.arange(len(rows))
+            top = top[np.argsort(d2[top])]
+            top = top[np.isfinite(d2[top])]
+            dists = np.sqrt(np.maximum(d2[top], 0.0))
+            results.append([(self._labels[rows[i]], float(dist)) for i, dist in zip(top, dists)])
+        return results[0] if single else results
+
+    def needs_retrain(self):
+        if self.trained_size < MIN_TRAIN:
+            return len(self) >= MIN_TRAIN
+        return len(self) > RETRAIN_GROWTH * self.trained_size
+
+    #  Retrain on the current contents and re-file every row
+    def rebuild(self):
+        keys = np.flatnonzero(self._cell_of >= 0)
+        self.train(keys)
+        self.add(keys)
+        return self
+
+
+#  Index kept in step with a memory-mapped gallery.Gallery, keyed by gallery row
+#  and reading the vectors from its matrix
+class GalleryIndex():
+
+    def __init__(self, n_lists=None, n_probe=N_PROBE):
+        self.index = IVFIndex(n_lists=n_lists, n_probe=n_probe)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self._gallery = None
+        self._file_id = None
+        self._indexed = np.zeros(0, dtype=bool)
+        self._lock = threading.Lock()
+
+    #  Apply rows appended and tombstoned since the last sync; a compacted or
+    #  different gallery file is re-indexed from scratch
+    def sync(self, gallery):
+        with self._lock:
+            if gallery is self._gallery:
+                return self
+
+            valid = gallery.valid_mask()
+            file_id = (gallery.path, gallery.inode)
+            if file_id != self._file_id or len(gallery) < len(self._indexed):
+                self.index = IVFIndex(n_lists=self.n_lists, n_probe=self.n_probe)
+                self.index.attach(gallery.matrix, gallery.ids).train(np.flatnonzero(valid))
+                self._indexed = np.zeros(0, dtype=bool)
+                self._file_id = file_id
+            else:
+                self.index.attach(gallery.matrix, gallery.ids)
+
+            synced = len(self._indexed)
+            self.index.remove(np.flatnonzero(self._indexed & ~valid[:synced]))
+            self.index.add(np.flatnonzero(valid[synced:]) + synced)
+            self._indexed = valid.copy()
+
+            if self.index.needs_retrain():
+                logging.info("Retraining ANN index at %d vectors", len(self.index))
+                self.index.rebuild()
+            self._gallery = gallery
+        return self
+
+    def search(self, probes, k=1, n_probe=None):
+        with self._lock:
+            return self.index.search(probes, k, n_probe)
+
+
+_gallery_index = GalleryIndex()
+
+
+#  Process-wide index over gallery.get_gallery(), synced on every call
+def get_index():
+    from gallery import get_gallery
+    return _gallery_index.sync(get_gallery())
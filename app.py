@@ -1,5 +1,5 @@
 import argparse
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, Response
 from werkzeug.utils import secure_filename
 import socket
 from functools import wraps
@@ -9,10 +9,22 @@ import os
 import shutil
 from extraction_face_to_csv import extraction
 from attendance_taker import Face_Recognizer
+from gallery import get_gallery, get_resident_gallery
+from registry import get_registry
+from attendance_store import get_attendance_store
+from result_cache import ResultCache, gallery_version
+from descriptor_cache import content_hash
+from face_pipeline import FaceImage
+from extraction_face_to_csv import ENROLL_UPSAMPLE
 import uuid
+import math
+import logging
 import tempfile
-import dlib
-import cv2
+import face_models
+from serving import InferenceExecutor, Overloaded
+from batching import MicroBatcher
+from quality import ImageRejected, check_image, check_faces
+import metrics
 
 app = Flask(__name__)
 
@@ -25,23 +37,51 @@ app = Flask(__name__)
 
 UPLOAD_FOLDER = 'data/data_faces_from_camera/person_'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+CHECK_FOLDER = 'data/check'
+# Keep a copy of every attendance image in CHECK_FOLDER (written in the background)
+app.config['SAVE_CHECK_IMAGES'] = os.environ.get('SAVE_CHECK_IMAGES', '0') == '1'
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 16MB limit
+# Inference pool: worker threads, bounded queue length, max seconds a task may wait queued
+app.config['INFERENCE_WORKERS'] = int(os.environ.get('INFERENCE_WORKERS', '4'))
+app.config['INFERENCE_QUEUE_SIZE'] = int(os.environ.get('INFERENCE_QUEUE_SIZE', '32'))
+app.config['INFERENCE_MAX_WAIT'] = float(os.environ.get('INFERENCE_MAX_WAIT', '10'))
+# Micro-batching of /take_attendance: collection window (0 disables) and max requests per batch
+app.config['BATCH_WINDOW_MS'] = float(os.environ.get('BATCH_WINDOW_MS', '5'))
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', '16'))
+# Reject blurry, badly exposed and badly framed images before the models run
+app.config['QUALITY_GATE'] = os.environ.get('QUALITY_GATE', '1') == '1'
+# Load the dlib models at import, so a prefork master (gunicorn --preload) shares them with its workers
+app.config['PRELOAD_MODELS'] = os.environ.get('PRELOAD_MODELS', '1') == '1'
 lib = libs()
+# CPU-heavy stages run here, full queue -> 503 + Retry-After. Rejected images
+# are 422 responses, not failures worth a traceback in the log.
+inference = InferenceExecutor(app.config['INFERENCE_WORKERS'], app.config['INFERENCE_QUEUE_SIZE'],
+                              app.config['INFERENCE_MAX_WAIT'], expected_errors=(ImageRejected,))
+
+# Gallery loaded once at startup; /upload and /delete_user update it in place
+get_gallery()
+if app.config['PRELOAD_MODELS']:
+    face_models.preload()
+# verify/identify keep no per-request state, one recognizer serves every request
+recognizer = Face_Recognizer()
+
+def verify_requests(requests):
+    return recognizer.verify_batch(requests)
+
+# Concurrent attendance checks are verified together, one batch per inference task
+verify_batcher = MicroBatcher(verify_requests, app.config['BATCH_MAX_SIZE'],
+                              app.config['BATCH_WINDOW_MS'] / 1000.0, executor=inference,
+                              expected_errors=(ImageRejected,))
+
+# Verdicts of /take_attendance by (user_id, image hash, gallery version), answers client retries
+result_cache = ResultCache()
 
 # util function
 def validUser(user_id):
     
     if not user_id:
         return False
-    userExists = False
-    person_list = os.listdir("data/export/")
-    for person in person_list:
-        if person == user_id+".csv":
-            userExists = True
-            break
-    if not userExists:
-        return False
-    return True
+    return user_id in get_gallery()
 
 def handle_exceptions(func):
     @wraps(func)
@@ -56,17 +96,84 @@ def handle_exceptions(func):
     return wrapper
 
 
-def detect_face(image_path):
-    # # Load the image
-    image_cv = cv2.imread(image_path)
-    # Convert the image to grayscale
-    gray_image = cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
-    # Perform histogram equalization to improve contrast
-    image = cv2.equalizeHist(gray_image)
-    face_detector = dlib.get_frontal_face_detector()
-    
-    # Detect faces in the image
-    faces = face_detector(image)
+# Endpoint label for metrics; unknown paths share one label
+def endpoint_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def start_request_trace():
+    metrics.start_trace()
+
+
+@app.after_request
+def record_request(response):
+    trace = metrics.current_trace()
+    if trace is not None:
+        elapsed = trace.elapsed()
+        metrics.REGISTRY.count_request(endpoint_label(), request.method, response.status_code, elapsed)
+        logging.debug("%s %s %d %.1fms %s", request.method, request.path, response.status_code,
+                      elapsed * 1000.0, trace.summary())
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exc):
+    if exc is not None:
+        metrics.REGISTRY.count_error(endpoint_label(), type(exc).__name__)
+    metrics.end_trace()
+
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    metrics.REGISTRY.count_error(endpoint_label(), 'overloaded')
+    return {
+        'success': False,
+        'message': 'Server busy, please retry later'
+    }, 503, {'Retry-After': str(e.retry_after)}
+
+
+@app.errorhandler(ImageRejected)
+def handle_rejected(e):
+    metrics.REGISTRY.count_error(endpoint_label(), 'rejected_' + e.reason)
+    response = {'success': False}
+    response.update(e.to_dict())
+    return response, 422
+
+
+# Pixel checks (blur, exposure) on the request thread, before any model work is queued
+def screen_image(face_image, index=None):
+    if not app.config['QUALITY_GATE']:
+        return
+    try:
+        check_image(face_image)
+    except ImageRejected as e:
+        e.image = index
+        raise
+
+
+# Face box checks after detection, before landmarks and descriptors; runs on the executor
+def screen_faces(face_image, index=None):
+    if not app.config['QUALITY_GATE']:
+        return
+    try:
+        check_faces(face_image, max_faces=1)
+    except ImageRejected as e:
+        e.image = index
+        raise
+
+
+#  Detection and landmarks of one probe as its own inference task, so that a
+#  micro-batch only shares the descriptor network and the match
+def locate_face(face_image):
+    screen_faces(face_image)
+    face_image.shapes
+
+
+def detect_face(face_image):
+    # Detect faces in the equalized image; the result is kept on face_image
+    # and reused for landmarks and descriptors
+    faces = face_image.faces
     
     # Return True if faces were detected, False otherwise
     if len(faces) > 0:
@@ -74,6 +181,22 @@ def detect_face(image_path):
     else:
         return False
     
+'''
+1. detect a face in every decoded image
+2. if all have one, enroll from memory (the caller stores the files in the background)
+3. if not, nothing has been written and we give the appropirate return
+'''
+def enroll_images(user_id, images):
+    for i, face_image in enumerate(images, 1):
+        screen_faces(face_image, i)
+        if not detect_face(face_image):
+            logging.info("Face not detected in upload for %s", user_id)
+            return False
+
+    extract_face = extraction()
+    extract_face.enroll(user_id, images)
+    return True
+
 @app.route('/')
 def index():
     return {
@@ -100,44 +223,25 @@ def upload_images():
                 'message': f'Image{i} not received!'
             }, 400
             
-        else:
-           
-            # If a face is detected, append the image to the images list
-            images.append(image)
-                    
-    print("saving images ")
-    folder = lib.save_images(UPLOAD_FOLDER,user_id, images)
-    print(folder)
-    print("after saving the image")
-
-    '''
-    1. loop the folder 
-    2. pass the each image actual image path to detect_face(image_path)
-    3. if true return image uploaded successfully
-    4. if false delete the folder and give the appropirate return
-    '''    
-     # Loop through the saved images in the folder
-    image_paths = [os.path.join(folder, filename) for filename in os.listdir(folder)]
-    all_faces_detected = True
-    for image_path in image_paths:
-        print("Image path loop")
-        
-        if not detect_face(image_path):
-            print("Face not deteched")
-            all_faces_detected = False
-            break
+        # Decode straight from the upload stream, nothing touches the disk yet
+        face_image = lib.decode_image(image, upsample=ENROLL_UPSAMPLE, max_faces=1)
+        if face_image is None:
+            return {
+                'success': False,
+                'message': f'Image{i} could not be decoded!'
+            }, 400
+        screen_image(face_image, i)
+        images.append(face_image)
 
-    if all_faces_detected:
-        print("Trying to extracting the face")
-        extract_face = extraction()
-        extract_face.main(user_id) 
+    if inference.run(enroll_images, user_id, images):
+        result_cache.invalidate(user_id)
+        lib.save_images_async(UPLOAD_FOLDER, user_id, [face_image.data for face_image in images])
         return {
             'success': True,
             'Message': 'Images uploaded successfully',
         }
     else:
-        # If any image does not contain a face, delete the folder and return an error
-        # shutil.rmtree(folder)
+        # If any image does not contain a face, return an error
         return {
             'success': False,
             'message': 'Face not detected in given images.',
@@ -153,23 +257,13 @@ def delete_userid():
             'message': 'User ID is not provided!'
         }, 400  # Bad request if user_id is not provided
 
-    folder_path = "data/data_faces_from_camera/"  # Update this with the path to your folder
-    export_path = f"data/export/{user_id}.csv" 
-    # Get the list of files in the folder
-    files = os.listdir(folder_path)
-    deleted_files = []
-
-    for file_name in files:
-        start = file_name.find("_",7)
-        e_user_id = file_name[start+1:]
-
-        if e_user_id == user_id:
-            folder_path = os.path.join(folder_path, file_name)
-            shutil.rmtree(folder_path) 
-            deleted_files.append(file_name)
+    # Look the user's folder up in the registry instead of scanning every folder
+    registered = get_registry().delete(user_id)
 
-    if deleted_files:
-        os.remove(export_path)
+    if registered:
+        shutil.rmtree(registered['folder'], ignore_errors=True)
+        get_resident_gallery().remove(user_id)
+        result_cache.invalidate(user_id)
         return {
             'success': True,
             'message': f'Files for user ID : {user_id} deleted!'
@@ -180,6 +274,42 @@ def delete_userid():
             'message': f'No files found for user ID : {user_id} or Invalid userID!'
         }
 
+@app.route('/identify', methods=['POST'])
+def identify():
+    images = request.files.getlist('image')
+    # Check if only one image is provided
+    if len(images) != 1:
+        return {
+            'success': False,
+            'message': 'Exactly one image should be provided'
+        }, 400
+
+    face_image = lib.decode_image(images[0], max_faces=1)
+    if face_image is None:
+        return {
+            'success': False,
+            'message': 'Image could not be decoded'
+        }, 400
+    screen_image(face_image)
+
+    k = request.form.get('k', 1, type=int)
+    if app.config['QUALITY_GATE']:
+        inference.run(screen_faces, face_image)
+    candidates = inference.run(recognizer.identify, face_image, k=max(1, min(k, 10)))
+
+    if not candidates or candidates[0][1] >= recognizer.distance_threshold:
+        return {
+            'success': False,
+            'message': 'user not found',
+            'candidates': [{'user_id': user_id, 'distance': distance} for user_id, distance in candidates],
+        }
+    return {
+        'success': True,
+        'user_id': candidates[0][0],
+        'distance': candidates[0][1],
+        'candidates': [{'user_id': user_id, 'distance': distance} for user_id, distance in candidates],
+    }
+
 @app.route('/take_attendance', methods=['POST'])
 def take_attendance():
     user_id = request.form.get('user_id')
@@ -204,36 +334,130 @@ def take_attendance():
         }, 400
 
     image = images[0]  # Get the first image
-    
+    data = lib.read_image(image)
 
-    # Generate unique filename with UUID
-    unique_filename = str(uuid.uuid4()) + os.path.splitext(image.filename)[1]
-    save_path = os.path.join('data', 'check', unique_filename)
+    # A retry of an earlier submission gets the earlier verdict, no inference
+    # and no second attendance event
+    cache_key = (user_id, content_hash(data), gallery_version(get_gallery(), user_id))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return attendance_response(*cached)
 
-    # Save the image
-    image.save(save_path)
-    os.chmod(save_path, 0o777)  # 0o444 represents read permission for all users
-    Face_Recognizer_con = Face_Recognizer()
-    result = Face_Recognizer_con.run(user_id,unique_filename)
-    
-    print(result,"done")
-    if result == False or not result:
+    # One probe face: a group photo must not pass because anyone in it is the claimed user
+    face_image = FaceImage.from_bytes(data, max_faces=1)
+    if face_image is None:
+        return {
+            'success': False,
+            'message': 'Image could not be decoded'
+        }, 400
+    screen_image(face_image)
+
+    if app.config['SAVE_CHECK_IMAGES']:
+        # Generate unique filename with UUID
+        unique_filename = str(uuid.uuid4()) + os.path.splitext(image.filename or '')[1]
+        lib.save_file_async(os.path.join(CHECK_FOLDER, unique_filename), face_image.data)
+
+    if app.config['BATCH_WINDOW_MS'] > 0:
+        inference.run(locate_face, face_image)
+        matched, distance = verify_batcher.submit((user_id, face_image))
+    else:
+        if app.config['QUALITY_GATE']:
+            inference.run(screen_faces, face_image)
+        matched, distance = inference.run(recognizer.verify, user_id, face_image)
+
+    result_cache.put(cache_key, (matched, distance))
+    if matched:
+        # Queued for the background writer, the response does not wait for the disk
+        get_attendance_store().record(user_id, distance)
+    return attendance_response(matched, distance)
+
+
+def attendance_response(matched, distance):
+    if not matched:
         return {
             'success': False,
             'message': 'user not found',
+            # JSON has no NaN or Infinity
+            'distance': distance if math.isfinite(distance) else None,
         }
     else:
         return {
             'success': True,
-            'message': 'User_ID and the capture Matched!!'
+            'message': 'User_ID and the capture Matched!!',
+            'distance': distance,
         }
         
 
 
+# Parse an ISO 8601 date/time or unix seconds into unix seconds
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+@app.route('/attendance', methods=['GET'])
+def attendance_events():
+    user_id = request.args.get('user_id')
+    try:
+        start = parse_time(request.args.get('from'))
+        end = parse_time(request.args.get('to'))
+    except ValueError:
+        return {
+            'success': False,
+            'message': 'from / to must be ISO 8601 date-times or unix seconds'
+        }, 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    events = get_attendance_store().query(user_id, start, end, limit, offset)
+    return {
+        'success': True,
+        'events': events,
+    }
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return {
+        'success': True,
+        'inference': inference.stats(),
+        'batching': {
+            'batches': verify_batcher.batches,
+            'items': verify_batcher.items,
+        },
+        'attendance_store': get_attendance_store().stats(),
+        'result_cache': result_cache.stats(),
+        'gallery': get_resident_gallery().stats(),
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    text = metrics.REGISTRY.render()
+    text += metrics.render_gauges('face_inference', inference.stats(), 'Inference executor ')
+    text += metrics.render_gauges('face_batching', {'batches': verify_batcher.batches, 'items': verify_batcher.items},
+                                  'Micro-batching ')
+    text += metrics.render_gauges('face_attendance_store', get_attendance_store().stats(), 'Attendance writer ')
+    text += metrics.render_gauges('face_result_cache', result_cache.stats(), 'Verification result cache ')
+    text += metrics.render_gauges('face_gallery', get_resident_gallery().stats(), 'Resident gallery ')
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run the Flask app with specified host and port.')
     parser.add_argument('--host', default='0.0.0.0', help='Host IP address to run the server on.')
     parser.add_argument('--port', type=int, default=5001, help='Port number to run the server on.')
+    parser.add_argument('--inference-workers', type=int, default=app.config['INFERENCE_WORKERS'],
+                        help='Threads running detection and recognition.')
+    parser.add_argument('--queue-size', type=int, default=app.config['INFERENCE_QUEUE_SIZE'],
+                        help='Requests allowed to wait for a worker before answering 503.')
     args = parser.parse_args()
 
-    app.run(host=args.host, port=args.port)
\ No newline at end of file
+    inference = InferenceExecutor(args.inference_workers, args.queue_size, app.config['INFERENCE_MAX_WAIT'],
+                                  expected_errors=(ImageRejected,))
+    verify_batcher.executor = inference
+    app.run(host=args.host, port=args.port, threaded=True)
\ No newline at end of file
@@ -0,0 +1,176 @@
+# Attendance event store
+#
+# Every successful check-in becomes a row in a SQLite database in WAL mode.
+# record() only queues the event; a background writer thread drains the
+# queue and inserts whatever has accumulated (up to batch_size rows) in one
+# transaction, so a burst of check-ins costs one commit per batch instead of
+# one per request, and the request thread never waits on the disk.
+#
+# Events are indexed on (user_id, timestamp) for per-user history and on
+# timestamp for "who checked in this morning" ranges. Readers use their own
+# per-thread connections; WAL lets them run while the writer commits.
+
+import os
+import time
+import atexit
+import queue
+import sqlite3
+import datetime
+import threading
+import logging
+import metrics
+
+PATH_ATTENDANCE_DB = "data/attendance.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    distance REAL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_user_time ON events (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS events_time ON events (timestamp);
+"""
+
+
+class AttendanceStore():
+
+    def __init__(self, path=PATH_ATTENDANCE_DB, batch_size=500, flush_interval=0.05, queue_size=100000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pid = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    #  The writer thread is started on first use in every process (threads do not survive fork)
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            threading.Thread(target=self._writer, args=(self._queue,), name="attendance-writer",
+                             daemon=True).start()
+            if self._pid is None:
+                # Commit what is still queued when the interpreter exits
+                atexit.register(self.flush)
+            self._pid = os.getpid()
+
+    #  Queue one attendance event; returns False when the queue is full and the event was dropped
+    def record(self, user_id, distance=None, source="api", timestamp=None):
+        self._ensure_started()
+        event = (user_id, timestamp if timestamp is not None else time.time(), distance, source)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logging.warning("Attendance queue full, dropped event for %s", user_id)
+            return False
+        return True
+
+    def _writer(self, events):
+        conn = self._connect()
+        while True:
+            batch = [events.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(events.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            try:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT INTO events (user_id, timestamp, distance, source) VALUES (?, ?, ?, ?)",
+                                 batch)
+                conn.execute("COMMIT")
+                with self._lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except sqlite3.Error:
+                logging.exception("Failed to write %d attendance events", len(batch))
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                with self._lock:
+                    self.dropped += len(batch)
+            finally:
+                metrics.observe("persistence", time.perf_counter() - start)
+                for _ in batch:
+                    events.task_done()
+
+    #  Block until every event queued so far is committed
+    def flush(self):
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    #  Events in [start, end) (unix seconds), newest first
+    def query(self, user_id=None, start=None, end=None, limit=100, offset=0):
+        clauses, args = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            args.append(user_id)
+        if start is not None:
+            clauses.append("timestamp >= ?")
+            args.append(start)
+        if end is not None:
+            clauses.append("timestamp < ?")
+            args.append(end)
+        sql = "SELECT id, user_id, timestamp, distance, source FROM events"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
+        rows = self._connect().execute(sql, args + [limit, offset]).fetchall()
+        return [{
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'timestamp': datetime.datetime.fromtimestamp(row['timestamp']).isoformat(),
+            'distance': row['distance'],
+            'source': row['source'],
+        } for row in rows]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'written': self.written,
+                'batches': self.batches,
+                'dropped': self.dropped,
+                'pending': self._queue.qsize(),
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+#  Process-wide attendance store
+def get_attendance_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = AttendanceStore()
+        return _store
@@ -1,23 +1,18 @@
-import dlib
 import numpy as np
 import cv2
-import os
-import pandas as pd
 import time
 import logging
-import sqlite3
 import datetime
+import face_models
+import metrics
+from gallery import get_gallery, get_resident_gallery
+from matcher import GalleryMatcher, verify, verify_batch
+from face_pipeline import FaceImage, compute_descriptors_batch
+from ann_index import get_index
+from attendance_store import get_attendance_store
+from tracker import CentroidTracker, KeyframeDetector, MIN_TRACK_CONFIDENCE
 
 
-# Dlib  / Use frontal face detector of Dlib
-detector = dlib.get_frontal_face_detector()
-
-# Dlib landmark / Get face landmarks
-predictor = dlib.shape_predictor('data/data_dlib/shape_predictor_68_face_landmarks.dat')
-
-# Dlib Resnet Use Dlib resnet50 model to get 128D face descriptor
-face_reco_model = dlib.face_recognition_model_v1("data/data_dlib/dlib_face_recognition_resnet_model_v1.dat")
-
 class Face_Recognizer:
     def __init__(self):
         # self.font = cv2.FONT_ITALIC
@@ -36,6 +31,10 @@ class Face_Recognizer:
         self.face_features_known_list = []
         # / Save the name of faces in the database
         self.face_name_known_list = []
+        #  Vectorized matcher over the features above
+        self.matcher = None
+        #  Faces closer than this e-distance are the same person
+        self.distance_threshold = 0.4
 
         #  List to save centroid positions of ROI in frame N-1 and N
         self.last_frame_face_centroid_list = []
@@ -60,30 +59,37 @@ class Face_Recognizer:
         # e distance between centroid of ROI in last and current frame
         self.last_current_frame_centroid_e_distance = 0
 
+        #  Tracks of the faces seen in the stream, and the track id of every face in frame N
+        self.tracker = CentroidTracker()
+        self.current_frame_face_track_id_list = []
+        #  Streaming: keyframe detection with correlation tracking in between,
+        #  and [frames, seconds] spent per mode
+        self.keyframes = None
+        self.mode_timings = {"detect": [0, 0.0], "track": [0, 0.0]}
+
         #  Reclassify after 'reclassify_interval' frames
         self.reclassify_interval_cnt = 0
         self.reclassify_interval = 10
 
-    #  "features_all.csv"  / Get known faces from "features_all.csv"
+        #  Whether recognition ran on the current frame
+        self.current_frame_recognized = False
+        #  Streaming: last attendance event per person, and the minimum gap between two
+        self.last_event_time = {}
+        self.event_cooldown = 60
+
+    #  Get known faces from the current snapshot of the resident gallery
     def get_face_database(self,user_id):
-        if os.path.exists(f"data/export/{user_id}.csv"):
-            path_features_known_csv = f"data/export/{user_id}.csv"
-            csv_rd = pd.read_csv(path_features_known_csv, header=None)
-            for i in range(csv_rd.shape[0]):
-                features_someone_arr = []
-                self.face_name_known_list.append(csv_rd.iloc[i][0])
-                for j in range(1, 129):
-                    if csv_rd.iloc[i][j] == '':
-                        features_someone_arr.append('0')
-                    else:
-                        features_someone_arr.append(csv_rd.iloc[i][j])
-                self.face_features_known_list.append(features_someone_arr)
-            logging.info("Faces in Database： %d", len(self.face_features_known_list))
+        gallery = get_gallery()
+        if len(gallery):
+            self.face_name_known_list = gallery.ids
+            self.face_features_known_list = gallery.matrix
+            self.matcher = GalleryMatcher(gallery.ids, gallery.matrix, gallery.valid_mask())
+            logging.info("Faces in Database： %d", len(self.matcher))
             return 1
         else:
-            logging.warning("'features_all.csv' not found!")
-            logging.warning("Please run 'get_faces_from_camera.py' "
-                            "and 'features_extraction_to_csv.py' before 'face_reco_from_camera.py'")
+            logging.warning("Gallery '%s' not found!", gallery.path)
+            logging.warning("Please register faces through /upload "
+                            "or run extraction().export_all() before taking attendance")
             return 0
 
     def update_fps(self):
@@ -104,21 +110,12 @@ class Face_Recognizer:
         dist = np.sqrt(np.sum(np.square(feature_1 - feature_2)))
         return dist
 
-    # / Use centroid tracker to link face_x in current frame with person_x in last frame
+    # / Use centroid tracker to link face_x in current frame with person_x in last frame:
+    #  every face takes the name recognized for its track
     def centroid_tracker(self):
-        for i in range(len(self.current_frame_face_centroid_list)):
-            e_distance_current_frame_person_x_list = []
-            #  For object 1 in current_frame, compute e-distance with object 1/2/3/4/... in last frame
-            for j in range(len(self.last_frame_face_centroid_list)):
-                self.last_current_frame_centroid_e_distance = self.return_euclidean_distance(
-                    self.current_frame_face_centroid_list[i], self.last_frame_face_centroid_list[j])
-
-                e_distance_current_frame_person_x_list.append(
-                    self.last_current_frame_centroid_e_distance)
-
-            last_frame_num = e_distance_current_frame_person_x_list.index(
-                min(e_distance_current_frame_person_x_list))
-            self.current_frame_face_name_list[i] = self.last_frame_face_name_list[last_frame_num]
+        tracks = [self.tracker[track_id] for track_id in self.current_frame_face_track_id_list]
+        self.current_frame_face_name_list = [track.name for track in tracks]
+        self.current_frame_face_X_e_distance_list = [track.distance for track in tracks]
 
     #  cv2 window / putText on cv2 window
     def draw_note(self, img_rd):
@@ -130,183 +127,326 @@ class Face_Recognizer:
                     cv2.LINE_AA)
         cv2.putText(img_rd, "Faces:  " + str(self.current_frame_face_cnt), (20, 160), cv2.FONT_ITALIC, 0.8, (0, 255, 0), 1,
                     cv2.LINE_AA)
+        if self.keyframes is not None:
+            cv2.putText(img_rd, "Mode:   " + ("detect" if self.keyframes.keyframe else "track"), (20, 190),
+                        cv2.FONT_ITALIC, 0.8, (0, 255, 0), 1, cv2.LINE_AA)
         cv2.putText(img_rd, "Q: Quit", (20, 450), cv2.FONT_ITALIC, 0.8, (255, 255, 255), 1, cv2.LINE_AA)
 
         for i in range(len(self.current_frame_face_name_list)):
-            img_rd = cv2.putText(img_rd, "Face_" + str(i + 1), tuple(
+            img_rd = cv2.putText(img_rd, "Face_" + str(self.current_frame_face_track_id_list[i]), tuple(
                 [int(self.current_frame_face_centroid_list[i][0]), int(self.current_frame_face_centroid_list[i][1])]),
                                  cv2.FONT_ITALIC,
                                  0.8, (255, 190, 0),
                                  1,
                                  cv2.LINE_AA)
-    # insert data in database
+    # insert data in database: events are queued for the batched attendance store
+    def save_event(self, event):
+        get_attendance_store().record(event['user_id'], event['distance'], source="stream",
+                                      timestamp=event['time'])
+
+    #  Face detection and recognition wit OT for one frame of a stream.
+    #  face_image is a face_pipeline.FaceImage of the decoded frame. Returns the
+    #  names of the faces in this frame ("unknown" for strangers).
+    def process_frame(self, face_image):
+        self.frame_cnt += 1
+        self.current_frame_recognized = False
+
+        # 2.  Detect faces for frame X (on the equalized grayscale image)
+        img_rd = face_image.img_rd
+        faces = face_image.faces
+
+        # 3.  Update cnt for faces in frames
+        self.last_frame_face_cnt = self.current_frame_face_cnt
+        self.current_frame_face_cnt = len(faces)
+
+        # 4.  Update the face name list in last frame
+        self.last_frame_face_name_list = self.current_frame_face_name_list[:]
+
+        # 5.  update frame centroid list
+        self.last_frame_face_centroid_list = self.current_frame_face_centroid_list
+        self.current_frame_face_centroid_list = []
 
-    #  Face detection and recognition wit OT from input video stream
-    def process(self, user_id, img_file):
+        # 5.1  Link the faces of this frame to the tracks of the last frames
+        self.current_frame_face_track_id_list = self.tracker.update(
+            [[(d.left() + d.right()) / 2, (d.top() + d.bottom()) / 2] for d in faces])
 
-        if self.get_face_database(user_id):
-            while True:    
-                self.frame_cnt += 1
-
-    
-                kk = 1
-
-                # 2.  Detect faces for frame X
-                # img_rd = dlib.load_rgb_image()
-                
-                #  Load the image
-                img_rd = cv2.imread('data/check/'+img_file)
-                # Convert the image to grayscale
-                gray_image = cv2.cvtColor(img_rd, cv2.COLOR_BGR2GRAY)
-                # Perform histogram equalization to improve contrast
-                image = cv2.equalizeHist(gray_image)
-    
-                detector = dlib.get_frontal_face_detector()
-                faces = detector(image)
-                # if faces == None:
-                #     return "Face not found"  
-
-                # 3.  Update cnt for faces in frames
-                self.last_frame_face_cnt = self.current_frame_face_cnt
-                self.current_frame_face_cnt = len(faces)
-
-                # 4.  Update the face name list in last frame
-                self.last_frame_face_name_list = self.current_frame_face_name_list[:]
-
-                # 5.  update frame centroid list
-                self.last_frame_face_centroid_list = self.current_frame_face_centroid_list
-                self.current_frame_face_centroid_list = []
-
-                # 6.1  if cnt not changes
-                if (self.current_frame_face_cnt == self.last_frame_face_cnt) and (
-                        self.reclassify_interval_cnt != self.reclassify_interval):
-                    logging.debug("scene 1:   No face cnt changes in this frame!!!")
-
-                    self.current_frame_face_position_list = []
-
-                    if "unknown" in self.current_frame_face_name_list:
-                        self.reclassify_interval_cnt += 1
-
-                    if self.current_frame_face_cnt != 0:
-                        
-                        # print("Found : ",len(faces))
-                        # print(faces)
-                        # print(type(faces))
-                        
-                        
-                        
-                        for k, d in enumerate(faces):
-                            self.current_frame_face_position_list.append(tuple(
-                                [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
-                            self.current_frame_face_centroid_list.append(
-                                [int(faces[k].left() + faces[k].right()) / 2,
-                                 int(faces[k].top() + faces[k].bottom()) / 2])
-
-                            img_rd = cv2.rectangle(img_rd,
-                                                   tuple([d.left(), d.top()]),
-                                                   tuple([d.right(), d.bottom()]),
-                                                   (255, 255, 255), 2)
-
-                    #  Multi-faces in current frame, use centroid-tracker to track
-                    if self.current_frame_face_cnt != 1:
-                        self.centroid_tracker()
-
-                    # for i in range(self.current_frame_face_cnt):
-                    #     # 6.2 Write names under ROI
-                    #     img_rd = cv2.putText(img_rd, self.current_frame_face_name_list[i],
-                    #                          self.current_frame_face_position_list[i], cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 1,
-                    #                          cv2.LINE_AA)
-                    # self.draw_note(img_rd)
-
-                # 6.2  If cnt of faces changes, 0->1 or 1->0 or ...
-                else:
-                    logging.debug("scene 2: / Faces cnt changes in this frame")
-                    self.current_frame_face_position_list = []
-                    self.current_frame_face_X_e_distance_list = []
-                    self.current_frame_face_feature_list = []
-                    self.reclassify_interval_cnt = 0
-
-                    # 6.2.1  Face cnt decreases: 1->0, 2->1, ...
-                    if self.current_frame_face_cnt == 0:
-                        logging.debug("  / No faces in this frame!!!")
-                        # clear list of names and features
-                        self.current_frame_face_name_list = []
-                    # 6.2.2 / Face cnt increase: 0->1, 0->2, ..., 1->2, ...
+        # 6.1  if cnt not changes and every face continues a track
+        if (self.current_frame_face_cnt == self.last_frame_face_cnt) and (
+                self.reclassify_interval_cnt != self.reclassify_interval) and not self.tracker.new_tracks:
+            logging.debug("scene 1:   No face cnt changes in this frame!!!")
+
+            self.current_frame_face_position_list = []
+
+            if "unknown" in self.current_frame_face_name_list:
+                self.reclassify_interval_cnt += 1
+
+            if self.current_frame_face_cnt != 0:
+                for k, d in enumerate(faces):
+                    self.current_frame_face_position_list.append(tuple(
+                        [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
+                    self.current_frame_face_centroid_list.append(
+                        [int(faces[k].left() + faces[k].right()) / 2,
+                         int(faces[k].top() + faces[k].bottom()) / 2])
+
+                    img_rd = cv2.rectangle(img_rd,
+                                           tuple([d.left(), d.top()]),
+                                           tuple([d.right(), d.bottom()]),
+                                           (255, 255, 255), 2)
+
+            #  Carry the names forward with the centroid-tracker
+            self.centroid_tracker()
+
+        # 6.2  If cnt of faces changes, 0->1 or 1->0 or ...
+        else:
+            logging.debug("scene 2: / Faces cnt changes in this frame")
+            self.current_frame_face_position_list = []
+            self.current_frame_face_X_e_distance_list = []
+            self.current_frame_face_feature_list = []
+            self.reclassify_interval_cnt = 0
+
+            # 6.2.1  Face cnt decreases: 1->0, 2->1, ...
+            if self.current_frame_face_cnt == 0:
+                logging.debug("  / No faces in this frame!!!")
+                # clear list of names and features
+                self.current_frame_face_name_list = []
+            # 6.2.2 / Face cnt increase: 0->1, 0->2, ..., 1->2, ...
+            else:
+                logging.debug("  scene 2.2  Get faces in this frame and do face recognition")
+                # Landmarks and descriptors reuse the detection above
+                self.current_frame_face_feature_list = list(face_image.descriptors)
+                self.current_frame_face_name_list = ["unknown"] * len(faces)
+                self.current_frame_recognized = True
+
+                # 6.2.2.1 Match every face against the whole database at once
+                with metrics.timed("match", face_image.trace):
+                    matches = self.matcher.search(np.array(self.current_frame_face_feature_list), k=1)
+
+                for k in range(len(faces)):
+                    logging.debug("  For face %d in current frame:", k + 1)
+                    self.current_frame_face_centroid_list.append(
+                        [int(faces[k].left() + faces[k].right()) / 2,
+                         int(faces[k].top() + faces[k].bottom()) / 2])
+
+                    # 6.2.2.2  Positions of faces captured
+                    self.current_frame_face_position_list.append(tuple(
+                        [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
+
+                    # 6.2.2.3 / Nearest person in the database and its e-distance
+                    if not matches[k]:
+                        self.current_frame_face_X_e_distance_list.append(float("inf"))
+                        logging.debug("  Face recognition result: Unknown person")
+                        continue
+                    nam, e_distance = matches[k][0]
+                    self.current_frame_face_X_e_distance_list.append(e_distance)
+                    track = self.tracker[self.current_frame_face_track_id_list[k]]
+                    track.distance = e_distance
+                    logging.debug("      nearest person %s, the e-distance: %f", nam, e_distance)
+
+                    if e_distance < self.distance_threshold:
+                        self.current_frame_face_name_list[k] = nam
+                        track.name = nam
+                        logging.debug("  Face recognition result: %s", nam)
                     else:
-                        logging.debug("  scene 2.2  Get faces in this frame and do face recognition")
-                        self.current_frame_face_name_list = []
-                        for i in range(len(faces)):
-                            shape = predictor(img_rd, faces[i])
-                            self.current_frame_face_feature_list.append(
-                                face_reco_model.compute_face_descriptor(img_rd, shape))
-                            self.current_frame_face_name_list.append("unknown")
-
-                        # 6.2.2.1 Traversal all the faces in the database
-                        for k in range(len(faces)):
-                            logging.debug("  For face %d in current frame:", k + 1)
-                            self.current_frame_face_centroid_list.append(
-                                [int(faces[k].left() + faces[k].right()) / 2,
-                                 int(faces[k].top() + faces[k].bottom()) / 2])
-
-                            self.current_frame_face_X_e_distance_list = []
-
-                            # 6.2.2.2  Positions of faces captured
-                            self.current_frame_face_position_list.append(tuple(
-                                [faces[k].left(), int(faces[k].bottom() + (faces[k].bottom() - faces[k].top()) / 4)]))
-
-                            # 6.2.2.3 
-                            # For every faces detected, compare the faces in the database
-                            for i in range(len(self.face_features_known_list)):
-                                # 
-                                if str(self.face_features_known_list[i][0]) != '0.0':
-                                    e_distance_tmp = self.return_euclidean_distance(
-                                        self.current_frame_face_feature_list[k],
-                                        self.face_features_known_list[i])
-                                    logging.debug("      with person %d, the e-distance: %f", i + 1, e_distance_tmp)
-                                    self.current_frame_face_X_e_distance_list.append(e_distance_tmp)
-                                else:
-                                    #  person_X
-                                    self.current_frame_face_X_e_distance_list.append(999999999)
-
-                            # 6.2.2.4 / Find the one with minimum e distance
-                            similar_person_num = self.current_frame_face_X_e_distance_list.index(
-                                min(self.current_frame_face_X_e_distance_list))
-
-                            print("values ",min(self.current_frame_face_X_e_distance_list))
-                            if min(self.current_frame_face_X_e_distance_list) < 0.4:
-                                self.current_frame_face_name_list[k] = self.face_name_known_list[similar_person_num]
-                                logging.debug("  Face recognition result: %s",
-                                              self.face_name_known_list[similar_person_num])
-                                
-                                # Insert attendance record
-                                nam =self.face_name_known_list[similar_person_num]
-
-                                print(type(self.face_name_known_list[similar_person_num]))
-                                print(nam)
-                                return nam
-                            else:
-                                logging.debug("  Face recognition result: Unknown person")
-                                return "Face not found"
-
-                        # 7.  / Add note on cv2 window
-                        # self.draw_note(img_rd)
-
-                # 8.  'q'  / Press 'q' to exit
-                if kk == 1:
-                    break
+                        logging.debug("  Face recognition result: Unknown person")
 
-                self.update_fps()
-                cv2.namedWindow("camera", 1)
-                cv2.imshow("camera", img_rd)
+        logging.debug("Frame ends\n\n")
+        return self.current_frame_face_name_list
 
-                logging.debug("Frame ends\n\n")
+    #  Recognize the faces of a single still image
+    def process(self, user_id, face_image):
 
-    def run(self,user_id,img_name):
+        if self.get_face_database(user_id):
+            names = self.process_frame(face_image)
+            if not names:
+                return None
+            if names[0] == "unknown":
+                return "Face not found"
+            return names[0]
+
+    #  Attendance events of the current frame: faces recognized in it, at most
+    #  once per person every event_cooldown seconds
+    def frame_events(self, now):
+        events = []
+        if not self.current_frame_recognized:
+            return events
+        for name, e_distance in zip(self.current_frame_face_name_list, self.current_frame_face_X_e_distance_list):
+            if name == "unknown" or now - self.last_event_time.get(name, float("-inf")) < self.event_cooldown:
+                continue
+            self.last_event_time[name] = now
+            events.append({
+                'user_id': name,
+                'distance': e_distance,
+                'frame': self.frame_cnt,
+                'time': now,
+                'timestamp': datetime.datetime.fromtimestamp(now).isoformat(),
+            })
+        return events
+
+    #  Continuous attendance from a video file, device path or camera index.
+    #  Recognition runs only when the face count changes or unknown faces
+    #  outlive the reclassify interval; in between names are carried forward
+    #  by the centroid tracker. on_event(event) is called for every attendance
+    #  event (default: save_event); headless skips the cv2 window.
+    #  The HOG detector runs every keyframe_interval frames, or sooner when a
+    #  face's correlation tracker falls below min_track_confidence; in between
+    #  face boxes come from the correlation trackers.
+    def stream(self, source, headless=False, on_event=None, max_frames=None, keyframe_interval=1,
+               min_track_confidence=MIN_TRACK_CONFIDENCE):
+        if not self.get_face_database(None):
+            return
+        self.keyframes = KeyframeDetector(keyframe_interval, min_track_confidence)
+
+        on_event = on_event or self.save_event
+        cap = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+        if not cap.isOpened():
+            logging.error("Failed to open video source: %s", source)
+            return
+
+        try:
+            while max_frames is None or self.frame_cnt < max_frames:
+                ok, img_rd = cap.read()
+                if not ok:
+                    break
+
+                start = time.perf_counter()
+                face_image = FaceImage(img_rd)
+                self.keyframes.update(face_image)
+                self.process_frame(face_image)
+                timing = self.mode_timings["detect" if self.keyframes.keyframe else "track"]
+                timing[0] += 1
+                timing[1] += time.perf_counter() - start
+
+                for event in self.frame_events(time.time()):
+                    on_event(event)
+                self.update_fps()
 
-        result = self.process(user_id,img_name)
+                if not headless:
+                    # 7.  / Add names and note on cv2 window
+                    for i in range(len(self.current_frame_face_name_list)):
+                        cv2.putText(img_rd, self.current_frame_face_name_list[i],
+                                    self.current_frame_face_position_list[i], cv2.FONT_HERSHEY_SIMPLEX, 0.8,
+                                    (0, 255, 255), 1, cv2.LINE_AA)
+                    self.draw_note(img_rd)
+                    cv2.imshow("camera", img_rd)
+
+                    # 8.  'q'  / Press 'q' to exit
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
+        finally:
+            cap.release()
+            if not headless:
+                cv2.destroyAllWindows()
+            for mode, stats in self.fps_by_mode().items():
+                logging.info("%s frames: %d, %.1f fps", mode, stats['frames'], stats['fps'])
+
+    #  Frames processed and frames/sec per mode: keyframes with full
+    #  detection, and frames between keyframes with correlation tracking
+    def fps_by_mode(self):
+        return {mode: {'frames': frames, 'fps': frames / seconds if seconds > 0 else 0.0}
+                for mode, (frames, seconds) in self.mode_timings.items()}
+
+    #  Descriptors of every face of every image with batched network calls,
+    #  e.g. for a burst of frames or several group photos
+    def compute_descriptors_batch(self, face_images):
+        return compute_descriptors_batch(face_images)
+
+    #  Embeddings of user_id in a gallery snapshot. Rows tombstoned since the
+    #  snapshot was taken read as NaN; the current gallery is asked then.
+    @staticmethod
+    def live_embeddings(gallery, user_id):
+        embeddings = gallery.embeddings_for(user_id)
+        if np.isfinite(embeddings).all():
+            return embeddings
+        embeddings = get_resident_gallery(gallery.path).latest().embeddings_for(user_id)
+        return embeddings[np.isfinite(embeddings).all(axis=1)]
+
+    #  1:1 verification against the claimed user's embeddings only;
+    #  cost does not depend on the number of registered people
+    def verify(self, user_id, face_image):
+        embeddings = self.live_embeddings(get_gallery(), user_id)
+        if not len(embeddings):
+            logging.warning("No embeddings registered for %s", user_id)
+            return False, float("inf")
+
+        if not face_image.has_face():
+            logging.debug("  / No faces in this frame!!!")
+            return False, float("inf")
+
+        # The claim is decided on the first face only, whatever else is in the picture
+        descriptors = face_image.descriptors[:1]
+        with metrics.timed("match", face_image.trace):
+            matched, e_distance = verify(descriptors, embeddings, self.distance_threshold)
+        logging.debug("  Verification of %s: matched=%s e-distance=%f", user_id, matched, e_distance)
+        return matched, e_distance
+
+    #  verify() for a group of (user_id, face_image) requests: descriptors of
+    #  all images go through the network together and all claims are matched
+    #  with one matrix product. Returns [(matched, e-distance), ...].
+    #  Detection and landmarks are best done per request beforehand (see
+    #  app.locate_face); whatever is missing runs here one image at a time.
+    def verify_batch(self, requests):
+        gallery = get_gallery()
+        embeddings = [self.live_embeddings(gallery, user_id) for user_id, _ in requests]
+        face_images = [face_image for _, face_image in requests]
+        # Images without faces or claims without embeddings need no descriptors
+        todo = [face_image for face_image, e in zip(face_images, embeddings) if len(e) and face_image.has_face()]
+        compute_descriptors_batch(todo)
+
+        probes = [face_image.descriptors[:1] if len(e) and face_image.has_face() else np.empty((0, 128))
+                  for face_image, e in zip(face_images, embeddings)]
+        start = time.perf_counter()
+        results = verify_batch(probes, embeddings, self.distance_threshold)
+        elapsed = time.perf_counter() - start
+        for face_image in face_images:
+            metrics.observe("match", elapsed, face_image.trace)
+        for (user_id, _), (matched, e_distance) in zip(requests, results):
+            logging.debug("  Verification of %s: matched=%s e-distance=%f", user_id, matched, e_distance)
+        return results
+
+    #  1:N identification through the ANN index, no claimed user_id needed.
+    #  Returns the top-k (user_id, e-distance) candidates of the first face.
+    def identify(self, face_image, k=1):
+        if not face_image.has_face():
+            logging.debug("  / No faces in this frame!!!")
+            return []
+        descriptor = face_image.descriptors[0]
+        with metrics.timed("match", face_image.trace):
+            return get_index().search(descriptor, k=k)
+
+    def run(self,user_id,face_image):
+
+        result = self.process(user_id,face_image)
         if result == "Face not found":
             return False
         else:
-            print("Name of the person : ", result)
+            logging.info("Name of the person : %s", result)
             return result
 
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Take attendance continuously from a video file or camera.')
+    parser.add_argument('--source', default='0', help='Video file, device path (/dev/video0) or camera index.')
+    parser.add_argument('--headless', action='store_true', help='Do not open a cv2 window.')
+    parser.add_argument('--max-frames', type=int, default=None, help='Stop after this many frames.')
+    parser.add_argument('--cooldown', type=float, default=60, help='Seconds between two events for one person.')
+    parser.add_argument('--keyframe-interval', type=int, default=1,
+                        help='Run the face detector every N frames and track faces in between (1: every frame).')
+    parser.add_argument('--min-track-confidence', type=float, default=MIN_TRACK_CONFIDENCE,
+                        help='Detect again as soon as a tracked face falls below this confidence.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    face_models.preload()
+    Face_Recognizer_con = Face_Recognizer()
+    Face_Recognizer_con.event_cooldown = args.cooldown
+
+    def on_event(event):
+        print(json.dumps(event), flush=True)
+        Face_Recognizer_con.save_event(event)
+
+    Face_Recognizer_con.stream(args.source, headless=args.headless, max_frames=args.max_frames,
+                               on_event=on_event,
+                               keyframe_interval=args.keyframe_interval,
+                               min_track_confidence=args.min_track_confidence)
@@ -0,0 +1,98 @@
+# Micro-batching scheduler
+#
+# Requests arriving within a short window (max_wait seconds, or until
+# max_batch items are collected) are grouped and handed to handler(items) as
+# one list, which returns one result per item. Each caller blocks only for
+# its own result, so latency is bounded by the window plus one batch of work,
+# while descriptor computation and matching run once per group.
+#
+# With an executor (serving.InferenceExecutor) batches run on its workers and
+# inherit its backpressure: a rejected batch, or one that expired in the
+# executor's queue, raises Overloaded in every caller. Exceptions listed in
+# expected_errors are request outcomes and are passed on without logging.
+
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+
+
+class MicroBatcher():
+
+    def __init__(self, handler, max_batch=16, max_wait=0.005, executor=None, expected_errors=()):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.executor = executor
+        self.expected_errors = tuple(expected_errors)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._collect, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    #  Queue one item and wait for its result (or its exception)
+    def submit(self, item):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.items += len(batch)
+            if self.executor is not None:
+                try:
+                    task = self.executor.submit(self._run, batch)
+                except Exception as e:
+                    self._fail(batch, e)
+                else:
+                    # An expired task never calls _run, its callers still need an answer
+                    task.add_done_callback(lambda task, batch=batch: self._task_done(batch, task))
+            else:
+                self._run(batch)
+
+    def _task_done(self, batch, task):
+        if task.exception() is not None:
+            self._fail(batch, task.exception())
+
+    @staticmethod
+    def _fail(batch, e):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+    def _run(self, batch):
+        try:
+            results = self.handler([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError("Batch handler returned %d results for %d items" % (len(results), len(batch)))
+        except BaseException as e:
+            if isinstance(e, self.expected_errors):
+                logging.debug("Micro-batch of %d items rejected: %s", len(batch), e)
+            else:
+                logging.exception("Micro-batch of %d items failed", len(batch))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,93 @@
+# Recall / latency of the IVF index against exact search
+#
+# Builds synthetic galleries of clustered 128D identities, queries them with
+# noisy copies of enrolled vectors (a probe of an enrolled person) and
+# compares ann_index.IVFIndex with the exact matcher.GalleryMatcher scan:
+# recall@1 (same top-1 as exact search) and per-query latency.
+#
+#   python benchmarks/bench_ann.py
+#   python benchmarks/bench_ann.py --sizes 10000 100000 --n-probe 4 8 16 --json ann.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ann_index import IVFIndex
+from matcher import GalleryMatcher
+
+
+#  Identities scattered around a few hundred cluster centres, at the scale of dlib descriptors
+def synthetic_gallery(n, dim=128, clusters=256, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0.0, 0.05, (clusters, dim)).astype(np.float32)
+    gallery = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, 100000):
+        stop = min(n, start + 100000)
+        gallery[start:stop] = centres[rng.integers(0, clusters, stop - start)] + \
+            rng.normal(0.0, 0.05, (stop - start, dim)).astype(np.float32)
+    return gallery
+
+
+def timed(fn, queries):
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(fn(query))
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000.0
+    return results, float(latencies.mean()), float(np.percentile(latencies, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IVF index against exact search.")
+    parser.add_argument("--sizes", nargs="*", type=int, default=[10000, 100000, 1000000], help="Gallery sizes.")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per gallery size.")
+    parser.add_argument("--n-probe", nargs="*", type=int, default=[4, 8, 16, 32], help="Cells scanned per query.")
+    parser.add_argument("--noise", type=float, default=0.015, help="Per-dimension probe noise.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    results = []
+    for size in args.sizes:
+        gallery = synthetic_gallery(size)
+        ids = [str(i) for i in range(size)]
+        targets = rng.integers(0, size, args.queries)
+        queries = gallery[targets] + rng.normal(0.0, args.noise, (args.queries, gallery.shape[1])).astype(np.float32)
+
+        exact = GalleryMatcher(ids, gallery)
+        exact_results, exact_mean, exact_p99 = timed(lambda q: exact.search(q, k=1), queries)
+        exact_top1 = [r[0][0] for r in exact_results]
+        results.append({"size": size, "method": "exact", "mean_ms": exact_mean, "p99_ms": exact_p99, "recall": 1.0})
+
+        start = time.perf_counter()
+        index = IVFIndex().attach(gallery, ids).train()
+        index.add(np.arange(size))
+        build_s = time.perf_counter() - start
+
+        for n_probe in args.n_probe:
+            ann_results, mean, p99 = timed(lambda q: index.search(q, k=1, n_probe=n_probe), queries)
+            recall = np.mean([bool(r) and r[0][0] == top1 for r, top1 in zip(ann_results, exact_top1)])
+            results.append({"size": size, "method": "ivf", "n_lists": len(index.centroids), "n_probe": n_probe,
+                            "build_s": build_s, "mean_ms": mean, "p99_ms": p99, "recall": float(recall)})
+
+    print("%-9s %-6s %-8s %-8s %-10s %-10s %s" % ("size", "method", "n_lists", "n_probe", "mean ms", "p99 ms",
+                                                  "recall@1"))
+    for row in results:
+        print("%-9d %-6s %-8s %-8s %-10.3f %-10.3f %.3f" % (row["size"], row["method"], row.get("n_lists", "-"),
+                                                           row.get("n_probe", "-"), row["mean_ms"], row["p99_ms"],
+                                                           row["recall"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "ann", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Latency / recall of HOG detection at bounded resolutions
+#
+# Runs the detector on the demo images at several DETECT_MAX_SIDE caps and
+# reports, per cap, the mean detection time and the share of full-resolution
+# detections that are still found (IoU >= 0.5 after mapping back).
+#
+#   python benchmarks/bench_detect_resolution.py
+#   python benchmarks/bench_detect_resolution.py --caps 0 1280 1024 800 640 --upsample 1 --json out.json
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from face_pipeline import FaceImage
+
+DEFAULT_IMAGES = sorted(glob.glob(os.path.join(ROOT, "demo", "*.jpg"))) + [os.path.join(ROOT, "1mb.jpg")]
+
+
+def iou(a, b):
+    left, top = max(a.left(), b.left()), max(a.top(), b.top())
+    right, bottom = min(a.right(), b.right()), min(a.bottom(), b.bottom())
+    inter = max(0, right - left) * max(0, bottom - top)
+    union = a.width() * a.height() + b.width() * b.height() - inter
+    return inter / float(union) if union else 0.0
+
+
+def detect(data, cap, upsample, repeat):
+    timings = []
+    faces = None
+    for _ in range(repeat):
+        # A fresh FaceImage per run so nothing is cached between repeats
+        face_image = FaceImage.from_bytes(data, upsample=upsample, max_detect_side=cap)
+        start = time.perf_counter()
+        faces = face_image.faces
+        timings.append(time.perf_counter() - start)
+    return faces, float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HOG detection at bounded resolutions.")
+    parser.add_argument("--images", nargs="*", default=DEFAULT_IMAGES, help="Images to run on.")
+    parser.add_argument("--caps", nargs="*", type=int, default=[0, 2048, 1600, 1280, 1024, 800, 640, 480, 320],
+                        help="Longer-side caps; 0 is full resolution and the recall reference.")
+    parser.add_argument("--upsample", type=int, default=0, help="HOG upsampling level.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image and cap (median is reported).")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    images = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            images.append((os.path.basename(path), f.read()))
+
+    caps = [0] + [cap for cap in args.caps if cap != 0]
+    reference = {}
+    results = []
+    for cap in caps:
+        total_time, found, expected = 0.0, 0, 0
+        for name, data in images:
+            faces, elapsed = detect(data, cap, args.upsample, args.repeat)
+            total_time += elapsed
+            if cap == 0:
+                reference[name] = list(faces)
+            expected += len(reference[name])
+            found += sum(1 for ref in reference[name] if any(iou(ref, face) >= 0.5 for face in faces))
+        results.append({
+            "cap": cap,
+            "upsample": args.upsample,
+            "mean_ms": 1000.0 * total_time / len(images),
+            "recall": found / float(expected) if expected else 1.0,
+            "faces_expected": expected,
+            "faces_found": found,
+        })
+
+    print("%-8s %-10s %-8s %s" % ("cap", "mean ms", "recall", "found/expected"))
+    for row in results:
+        print("%-8s %-10.1f %-8.3f %d/%d" % (row["cap"] or "full", row["mean_ms"], row["recall"],
+                                           row["faces_found"], row["faces_expected"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "detect_resolution", "images": [name for name, _ in images],
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
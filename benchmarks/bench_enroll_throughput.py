@@ -0,0 +1,69 @@
+# Enrollment throughput (images/sec) by worker count
+#
+# Describes the same set of images with ParallelEnrollment at several worker
+# counts, with the descriptor cache disabled so every image is computed. Pool
+# start-up and model loading are excluded by a warm-up pass per worker count.
+#
+#   python benchmarks/bench_enroll_throughput.py --copies 16 --workers 1 2 4 8 16 32
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from parallel_enroll import ParallelEnrollment
+
+DEFAULT_IMAGES = sorted(glob.glob(os.path.join(ROOT, "demo", "*.jpg")))
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    default_workers = sorted({1, 2, 4, 8, 16, 32, cpus} & set(range(1, cpus + 1)))
+
+    parser = argparse.ArgumentParser(description="Benchmark enrollment throughput by worker count.")
+    parser.add_argument("--images", nargs="*", default=DEFAULT_IMAGES, help="Images to enroll.")
+    parser.add_argument("--copies", type=int, default=8, help="How many times the image set is repeated.")
+    parser.add_argument("--workers", nargs="*", type=int, default=default_workers, help="Worker counts to try.")
+    parser.add_argument("--chunk-size", type=int, default=4, help="Images per worker task.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    images = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    sources = [(i, images[i % len(images)]) for i in range(len(images) * args.copies)]
+
+    results = []
+    for workers in args.workers:
+        with ParallelEnrollment(workers, chunk_size=args.chunk_size, cache_path=None) as engine:
+            # Warm-up: start the pool and let the workers load the models
+            engine.describe(sources[:workers * args.chunk_size])
+
+            start = time.perf_counter()
+            descriptors = engine.describe(sources)
+            elapsed = time.perf_counter() - start
+
+        described = sum(1 for d in descriptors.values() if d is not None)
+        results.append({
+            "workers": workers,
+            "images": len(sources),
+            "described": described,
+            "seconds": elapsed,
+            "images_per_sec": len(sources) / elapsed,
+        })
+        print("workers=%-3d images=%-5d %.1f images/sec (%.2fs)" % (workers, len(sources), len(sources) / elapsed,
+                                                                  elapsed))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "enroll_throughput", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
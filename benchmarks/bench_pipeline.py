@@ -0,0 +1,263 @@
+# Per-stage latency of the recognition pipeline and of gallery scaling
+#
+# Image stages run on the demo images: decode, grayscale + equalizeHist, HOG
+# detection, 68-point landmarks and the ResNet descriptor. Gallery stages run
+# on synthetic galleries written to a temporary directory: load (header, ids
+# and memmap), building the matcher, 1:N search of one probe and 1:1
+# verification against one user's rows.
+#
+# Every result is a record with the stage, the gallery size where it applies
+# and median / p95 / mean milliseconds. Stages whose dependencies are
+# missing (cv2, dlib, the model files under data/data_dlib/) are recorded as
+# skipped with the reason. --json writes the records together with the
+# commit and environment; --compare prints the change against an earlier run.
+#
+#   python benchmarks/bench_pipeline.py --json bench-$(git rev-parse --short HEAD).json
+#   python benchmarks/bench_pipeline.py --sizes 10 1000 100000 --compare bench-base.json
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gallery import Gallery
+from matcher import GalleryMatcher, verify
+
+DEFAULT_IMAGES = sorted(glob.glob(os.path.join(ROOT, "demo", "*.jpg")))
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+
+class Skipped(Exception):
+    pass
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000.0
+    return {"median_ms": float(np.median(timings)), "p95_ms": float(np.percentile(timings, 95)),
+            "mean_ms": float(timings.mean()), "repeat": repeat}
+
+
+def _require_models(*names):
+    try:
+        import face_models
+    except ImportError as e:
+        raise Skipped("dlib not installed (%s)" % e)
+    for name in names:
+        path = getattr(face_models, name)
+        if not os.path.exists(os.path.join(ROOT, path)):
+            raise Skipped("model file missing: %s" % path)
+
+
+#  stage name -> fn(images, repeat) returning a measure() dict
+def bench_decode(images, repeat):
+    import cv2
+    buffers = [np.frombuffer(data, np.uint8) for data in images]
+    return measure(lambda: [cv2.imdecode(buf, cv2.IMREAD_COLOR) for buf in buffers], repeat)
+
+
+def bench_equalize(images, repeat):
+    import cv2
+    from face_pipeline import FaceImage
+    face_images = [FaceImage.from_bytes(data) for data in images]
+    return measure(lambda: [cv2.equalizeHist(cv2.cvtColor(f.img_rd, cv2.COLOR_BGR2GRAY)) for f in face_images],
+                   repeat)
+
+
+def bench_detect(images, repeat):
+    _require_models()
+    from face_pipeline import FaceImage
+    decoded = [FaceImage.from_bytes(data).img_rd for data in images]
+    # A fresh FaceImage per run so no detection is reused
+    return measure(lambda: [FaceImage(img_rd).faces for img_rd in decoded], repeat)
+
+
+def _detected(images):
+    from face_pipeline import FaceImage
+    face_images = [FaceImage.from_bytes(data) for data in images]
+    face_images = [f for f in face_images if f.has_face()]
+    if not face_images:
+        raise Skipped("no face detected in the benchmark images")
+    return face_images
+
+
+def bench_landmarks(images, repeat):
+    _require_models("PATH_PREDICTOR")
+    face_images = _detected(images)
+
+    def run():
+        for face_image in face_images:
+            face_image._shapes = None
+            face_image.shapes
+    return measure(run, repeat)
+
+
+def bench_descriptor(images, repeat):
+    _require_models("PATH_PREDICTOR", "PATH_FACE_RECO_MODEL")
+    face_images = _detected(images)
+    for face_image in face_images:
+        face_image.shapes
+
+    def run():
+        for face_image in face_images:
+            face_image._descriptors = None
+            face_image.descriptors
+    return measure(run, repeat)
+
+
+IMAGE_STAGES = [
+    ("decode", bench_decode),
+    ("equalize_hist", bench_equalize),
+    ("hog_detect", bench_detect),
+    ("landmarks", bench_landmarks),
+    ("descriptor", bench_descriptor),
+]
+
+
+#  Random unit-scale embeddings written through Gallery.append in chunks
+def synthetic_gallery(path, size, seed=0):
+    rng = np.random.default_rng(seed)
+    gallery = Gallery(path)
+    for start in range(0, size, 100000):
+        stop = min(size, start + 100000)
+        vectors = rng.normal(0.0, 0.05, (stop - start, gallery.dim)).astype(np.float32)
+        gallery.append([str(i) for i in range(start, stop)], vectors)
+    return gallery
+
+
+GALLERY_STAGES = ("gallery_load", "matcher_build", "match_1n", "verify_1_1")
+
+
+def bench_gallery(size, repeat, workdir):
+    path = os.path.join(workdir, "gallery_%d.bin" % size)
+    synthetic_gallery(path, size)
+    gallery = Gallery(path).load()
+    matcher = GalleryMatcher(gallery.ids, gallery.matrix, gallery.valid_mask())
+    rng = np.random.default_rng(1)
+    probe = rng.normal(0.0, 0.05, gallery.dim).astype(np.float32)
+    user_id = str(int(rng.integers(0, size)))
+
+    results = [
+        ("gallery_load", measure(lambda: Gallery(path).load(), repeat)),
+        ("matcher_build", measure(lambda: GalleryMatcher(gallery.ids, gallery.matrix, gallery.valid_mask()),
+                                  repeat)),
+        ("match_1n", measure(lambda: matcher.search(probe, k=1), repeat)),
+        ("verify_1_1", measure(lambda: verify(probe[None, :], gallery.embeddings_for(user_id), 0.4), repeat)),
+    ]
+    os.remove(path)
+    os.remove(path + ".ids")
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                             cwd=ROOT, stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _key(record):
+    return record["stage"], record.get("size")
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {_key(r): r for r in json.load(f)["results"] if "median_ms" in r}
+    print("\n%-14s %-9s %-12s %-12s %s" % ("stage", "size", "base ms", "now ms", "change"))
+    for record in results:
+        base = baseline.get(_key(record))
+        if base is None or "median_ms" not in record:
+            continue
+        change = (record["median_ms"] - base["median_ms"]) / base["median_ms"] * 100.0 if base["median_ms"] else 0.0
+        print("%-14s %-9s %-12.3f %-12.3f %+.1f%%" % (record["stage"], record.get("size", "-"), base["median_ms"],
+                                                      record["median_ms"], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage and gallery scaling.")
+    parser.add_argument("--images", nargs="*", default=DEFAULT_IMAGES, help="Images for the image stages.")
+    parser.add_argument("--sizes", nargs="*", type=int, default=DEFAULT_SIZES, help="Synthetic gallery sizes.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage (after one warm-up).")
+    parser.add_argument("--stages", nargs="*", help="Only run these stages (default: all).")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    # The model paths in face_models are relative to the repository root
+    os.chdir(ROOT)
+    images = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            images.append(f.read())
+
+    wanted = lambda stage: not args.stages or stage in args.stages
+    results = []
+    for stage, fn in IMAGE_STAGES:
+        if not wanted(stage):
+            continue
+        try:
+            record = {"stage": stage, "images": len(images)}
+            record.update(fn(images, args.repeat))
+        except (Skipped, ImportError) as e:
+            record = {"stage": stage, "skipped": str(e)}
+        results.append(record)
+
+    # Writing the synthetic galleries is not free, skip them when no gallery stage is wanted
+    sizes = args.sizes if any(wanted(stage) for stage in GALLERY_STAGES) else []
+    workdir = tempfile.mkdtemp(prefix="bench-gallery-")
+    try:
+        for size in sizes:
+            for stage, timing in bench_gallery(size, args.repeat, workdir):
+                if wanted(stage):
+                    record = {"stage": stage, "size": size}
+                    record.update(timing)
+                    results.append(record)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%-14s %-9s %-12s %-12s %s" % ("stage", "size", "median ms", "p95 ms", "mean ms"))
+    for record in results:
+        if "skipped" in record:
+            print("%-14s %-9s skipped: %s" % (record["stage"], "-", record["skipped"]))
+        else:
+            print("%-14s %-9s %-12.3f %-12.3f %.3f" % (record["stage"], record.get("size", "-"), record["median_ms"],
+                                                       record["p95_ms"], record["mean_ms"]))
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "pipeline", "environment": environment(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Bulk enrollment from a directory tree or a zip archive
+#
+# Every directory that directly holds images is one person; its name gives
+# the user_id the same way the registered folders do ("person_<n>_<user_id>"
+# or just "<user_id>"). Images at the top level are one person each, named
+# by the file name without extension. Zip members are read one batch of
+# people at a time straight from the archive, nothing is extracted first.
+#
+# People are described in batches on a ParallelEnrollment process pool and
+# every batch is written to the gallery with one upsert_many. After a batch
+# is in the gallery its user_ids are appended to a checkpoint file; a rerun
+# with the same checkpoint skips them, so an interrupted import resumes at
+# the first unfinished batch.
+#
+#   python bulk_enroll.py demo/face-capture.zip --workers 16
+#   python bulk_enroll.py /mnt/new-school/ --batch-size 512 --checkpoint school.done
+
+import os
+import sys
+import time
+import zipfile
+import argparse
+import logging
+import numpy as np
+from extraction_face_to_csv import extraction
+from descriptor_cache import content_hash, PATH_DESCRIPTOR_CACHE
+from gallery import Gallery
+from parallel_enroll import ParallelEnrollment, ENROLL_WORKERS
+from registry import get_registry
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+#  People described and written to the gallery together
+BATCH_SIZE = 256
+
+#  Checkpoints of imports, by source name
+PATH_CHECKPOINTS = "data/cache/bulk_enroll/"
+
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(name).startswith('.')
+
+
+#  A directory tree or a zip archive of person folders
+class EnrollmentSource():
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    #  {user_id: [member, ...]}, members are file paths or zip member names.
+    #  A zip is listed from its central directory only.
+    def people(self):
+        folders = {}
+        if self._zip is not None:
+            for info in self._zip.infolist():
+                if not info.is_dir() and _is_image(info.filename):
+                    folders.setdefault(os.path.dirname(info.filename), []).append(info.filename)
+        else:
+            for root, dirs, files in os.walk(self.path):
+                dirs.sort()
+                images = [os.path.join(root, name) for name in sorted(files) if _is_image(name)]
+                if images:
+                    folder = os.path.relpath(root, self.path)
+                    folders[folder if folder != "." else ""] = images
+
+        people = {}
+        for folder, members in folders.items():
+            if '__MACOSX' in folder.split(os.sep):
+                continue
+            if not folder:
+                for member in members:
+                    people.setdefault(os.path.splitext(os.path.basename(member))[0], []).append(member)
+                continue
+            name = os.path.basename(folder.rstrip('/'))
+            people.setdefault(extraction.person_name(name), []).extend(sorted(members))
+        return people
+
+    def read(self, member):
+        if self._zip is not None:
+            return self._zip.read(member)
+        with open(member, "rb") as f:
+            return f.read()
+
+
+class Checkpoint():
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.rstrip('\n') for line in f if line.strip())
+
+    def __contains__(self, user_id):
+        return user_id in self.done
+
+    #  Record finished user_ids; on disk before the next batch starts
+    def add(self, user_ids):
+        self.done.update(user_ids)
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(user_id + "\n" for user_id in user_ids)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+#  Copy the images into the user's registered folder (what /upload and
+#  export_all use)
+def save_images(folder, images):
+    os.makedirs(folder, exist_ok=True)
+    for data in images:
+        # Named by content, so a resumed batch does not store an image twice
+        path = os.path.join(folder, content_hash(data)[:32] + ".jpg")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+
+
+def bulk_enroll(path, workers=ENROLL_WORKERS, batch_size=BATCH_SIZE, checkpoint=None, copy_images=True,
+                gallery=None, cache_path=PATH_DESCRIPTOR_CACHE):
+    source = EnrollmentSource(path)
+    checkpoint = Checkpoint(checkpoint)
+    gallery = gallery if gallery is not None else Gallery()
+    registry = get_registry()
+
+    people = source.people()
+    todo = [user_id for user_id in sorted(people) if user_id not in checkpoint]
+    logging.info("%d people in %s, %d already imported", len(people), path, len(people) - len(todo))
+
+    enrolled = failed = 0
+    start = time.perf_counter()
+    try:
+        with ParallelEnrollment(workers, cache_path=cache_path) as engine:
+            for batch_start in range(0, len(todo), batch_size):
+                batch = todo[batch_start:batch_start + batch_size]
+                images = {user_id: [source.read(member) for member in people[user_id]] for user_id in batch}
+                means = engine.describe_people(images)
+
+                ok = [user_id for user_id in batch if means[user_id] is not None]
+                for user_id in batch:
+                    if means[user_id] is None:
+                        logging.warning("No face found for %s. Skipping.", user_id)
+                for user_id in ok:
+                    folder = registry.register(user_id)
+                    if copy_images:
+                        save_images(folder, images[user_id])
+                if ok:
+                    gallery.upsert_many(ok, np.stack([means[user_id] for user_id in ok]))
+                    registry.set_enrolled_many([(user_id, gallery.rows_for(user_id)[-1], len(images[user_id]))
+                                                for user_id in ok])
+                checkpoint.add(batch)
+
+                enrolled += len(ok)
+                failed += len(batch) - len(ok)
+                elapsed = time.perf_counter() - start
+                logging.info("%d/%d people (%.1f people/sec)", batch_start + len(batch), len(todo),
+                             (batch_start + len(batch)) / elapsed)
+    finally:
+        source.close()
+
+    gallery.compact()
+    registry.sync_gallery_rows(gallery)
+    logging.info("Enrolled %d people, %d without a usable face", enrolled, failed)
+    return enrolled, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll every person folder of a directory tree or zip archive.")
+    parser.add_argument("source", help="Directory or .zip with one folder of images per person.")
+    parser.add_argument("--workers", type=int, default=ENROLL_WORKERS, help="Enrollment processes.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="People per gallery write.")
+    parser.add_argument("--checkpoint", help="Progress file, resumes an interrupted import "
+                                             "(default: data/cache/bulk_enroll/<source>.done).")
+    parser.add_argument("--no-save-images", action="store_true",
+                        help="Only write the gallery, do not copy the images into the person folders.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    checkpoint = args.checkpoint or os.path.join(
+        PATH_CHECKPOINTS, os.path.basename(os.path.normpath(args.source)) + ".done")
+    enrolled, failed = bulk_enroll(args.source, args.workers, args.batch_size, checkpoint,
+                                   copy_images=not args.no_save_images)
+    return 0 if enrolled or not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# Persistent cache of 128D face descriptors keyed by image content hash
+#
+# Every enrolled image is hashed with SHA-256 and its descriptor is stored as
+# a small .npy file under data/cache/descriptors/<2 hex>/<hash>.npy. Images in
+# which no face was found are cached as an empty array so they are not
+# re-processed either; whether a face is found depends on the detection
+# settings (detection resolution cap, upsampling), so these entries are kept
+# per setting in <hash>.noface-<settings>.npy and a changed setting tries the
+# image again. Re-running extraction over the whole gallery then only costs
+# hashing, and the dlib models run for new images only. A cache created with
+# path=None is disabled (always misses, stores nothing).
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+PATH_DESCRIPTOR_CACHE = "data/cache/descriptors/"
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class DescriptorCache():
+
+    def __init__(self, path=PATH_DESCRIPTOR_CACHE):
+        self.path = path
+
+    #  detect_params: detection settings of a "no face" entry, e.g. (max_side, upsample)
+    def _entry_path(self, digest, detect_params=None):
+        suffix = "" if detect_params is None else ".noface-" + "-".join(str(p) for p in detect_params)
+        return os.path.join(self.path, digest[:2], digest + suffix + ".npy")
+
+    #  Return the cached descriptor, an empty array for "no face" with these
+    #  detect_params, or None on miss
+    def get(self, digest, detect_params=()):
+        if self.path is None:
+            return None
+        try:
+            descriptor = np.load(self._entry_path(digest))
+            # Older caches stored "no face" here, regardless of the detection settings
+            if descriptor.size:
+                return descriptor
+        except (OSError, ValueError):
+            pass
+        try:
+            return np.load(self._entry_path(digest, detect_params))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, digest, descriptor, detect_params=()):
+        if self.path is None:
+            return
+        if descriptor is None or isinstance(descriptor, int) or not np.size(descriptor):
+            descriptor = np.empty(0, dtype=np.float64)
+            entry_path = self._entry_path(digest, detect_params)
+        else:
+            entry_path = self._entry_path(digest)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Write to a temp file and rename so concurrent readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(descriptor, dtype=np.float64))
+            os.replace(temp_path, entry_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
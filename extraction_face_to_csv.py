@@ -1,54 +1,85 @@
 # Extract features from images and save into "features_all.csv"
 
 import os
-import dlib
-import csv
 import numpy as np
 import logging
-import cv2
+import metrics
+from face_pipeline import FaceImage, compute_descriptors_batch, DETECT_MAX_SIDE
+from descriptor_cache import DescriptorCache, content_hash, PATH_DESCRIPTOR_CACHE
+from gallery import Gallery, get_resident_gallery
+from registry import get_registry
+
+#  Enrollment images are detected with one level of upsampling
+ENROLL_UPSAMPLE = 1
 
 class extraction():
     global path_images_from_camera
-    global detector
-    global predictor
-    global face_reco_model
     
     #  Path of cropped faces
     path_images_from_camera = "data/data_faces_from_camera/"
 
-    #  Use frontal face detector of Dlib
-    detector = dlib.get_frontal_face_detector()
-
-    #  Get face landmarks
-    predictor = dlib.shape_predictor('data/data_dlib/shape_predictor_68_face_landmarks.dat')
+    #  Detector, landmark predictor and resnet50 descriptor model are shared
+    #  through the face_models registry
 
-    #  Use Dlib resnet50 model to get 128D face descriptor
-    face_reco_model = dlib.face_recognition_model_v1("data/data_dlib/dlib_face_recognition_resnet_model_v1.dat")
+    def __init__(self, cache_path=PATH_DESCRIPTOR_CACHE):
+        #  Descriptors of already processed images, keyed by content hash (None disables)
+        self.descriptor_cache = DescriptorCache(cache_path)
 
 
     #  Return 128D features for single image
 
     def return_128d_features(self,path_img):
-        img_rd = cv2.imread(path_img)
-        
-        # Check if the image was loaded successfully
-        if img_rd is None:
-            logging.error("Failed to load image: %s", path_img)
-            return 0  # Return 0 or an appropriate value to indicate failure
-    
-        faces = detector(img_rd, 1)
-
-        logging.info("%-40s %-20s", " Image with faces detected:", path_img)
-
-        # For photos of faces saved, we need to make sure that we can detect faces from the cropped images
-        if len(faces) != 0:
-            shape = predictor(img_rd, faces[0])
-            face_descriptor = face_reco_model.compute_face_descriptor(img_rd, shape)
-        else:
-            face_descriptor = 0
-            logging.warning("no face")
-            
-        return face_descriptor
+        with open(path_img, "rb") as f:
+            data = f.read()
+        return self.return_128d_features_from_bytes(data, path_img)
+
+    #  Same for image bytes already in memory; face_image may carry the decoded
+    #  image and its detections, digest its content hash, so nothing is redone
+    def return_128d_features_from_bytes(self, data, path_img="<upload>", face_image=None, digest=None):
+        return self.return_128d_features_batch([(data, path_img, face_image)], [digest])[0]
+
+    #  Batched version over (data, path_img, face_image or None) items, with
+    #  optional precomputed digests. Cache misses are detected image by image
+    #  and then described together with batched network calls.
+    def return_128d_features_batch(self, items, digests=None):
+        results = [0] * len(items)
+        misses = []
+        for i, (data, path_img, face_image) in enumerate(items):
+            # Reuse the descriptor if this exact image was processed before
+            digest = digests[i] if digests and digests[i] else content_hash(data)
+            if face_image is not None:
+                detect_params = (face_image.max_detect_side, face_image.upsample)
+            else:
+                detect_params = (DETECT_MAX_SIDE, ENROLL_UPSAMPLE)
+            cached = self.descriptor_cache.get(digest, detect_params)
+            if cached is not None:
+                results[i] = cached if cached.size else 0
+                continue
+
+            if face_image is None:
+                face_image = FaceImage.from_bytes(data, upsample=ENROLL_UPSAMPLE, max_faces=1)
+
+            # Check if the image was loaded successfully
+            if face_image is None:
+                logging.error("Failed to load image: %s", path_img)
+                continue  # Leave 0 to indicate failure
+            misses.append((i, digest, path_img, face_image, detect_params))
+
+        compute_descriptors_batch([miss[3] for miss in misses])
+
+        for i, digest, path_img, face_image, detect_params in misses:
+            logging.info("%-40s %-20s", " Image with faces detected:", path_img)
+
+            # For photos of faces saved, we need to make sure that we can detect faces from the cropped images
+            if face_image.has_face():
+                face_descriptor = face_image.descriptors[0]
+            else:
+                face_descriptor = 0
+                logging.warning("no face")
+
+            self.descriptor_cache.put(digest, face_descriptor, detect_params)
+            results[i] = face_descriptor
+        return results
 
 
     #   Return the mean value of 128D face descriptor for person X
@@ -57,59 +88,129 @@ class extraction():
         features_list_personX = []
         photos_list = os.listdir(path_face_personX)
         if photos_list:
+            #  Get 128D features for every image of personX in one batch
+            items = []
             for i in range(len(photos_list)):
-                #  return_128d_features()  128D  / Get 128D features for single image of personX
-                # logging.info("%-40s %-20s", " / Reading image:", path_face_personX + "/" + photos_list[i])
-                features_128d = self.return_128d_features(path_face_personX + "/" + photos_list[i])
-               
-                features_list_personX.append(features_128d)
+                with open(path_face_personX + "/" + photos_list[i], "rb") as f:
+                    items.append((f.read(), path_face_personX + "/" + photos_list[i], None))
+
+            for features_128d in self.return_128d_features_batch(items):
+                # Images without a face must not drag the mean towards zero
+                if isinstance(features_128d, np.ndarray):
+                    features_list_personX.append(features_128d)
         else:
             logging.warning(" Warning: No images in%s/", path_face_personX)
 
     
         if features_list_personX:
-            features_mean_personX = np.array(features_list_personX, dtype=object).mean(axis=0)
+            features_mean_personX = np.array(features_list_personX, dtype=np.float32).mean(axis=0)
         else:
             features_mean_personX = -1
         
-        print(type(features_mean_personX))
         return features_mean_personX
 
 
+    #  "person_<n>_<user_id>" folder name -> user_id
+    @staticmethod
+    def person_name(person):
+        if len(person.split('_', 2)) == 2:
+            return person
+        return person.split('_', 2)[-1]
+
+    #  Write the mean features of the given person folders into the gallery,
+    #  with one tombstone pass and one append for all of them
+    def export_people(self, person_list, gallery=None):
+        gallery = gallery if gallery is not None else Gallery()
+        means = {}
+        for person in person_list:
+            logging.info("%s%s", path_images_from_camera, person)
+            features_mean_personX = self.return_features_mean_personX(path_images_from_camera + person)
+            person_name = self.person_name(person)
+
+            # Check if features were successfully extracted
+            if isinstance(features_mean_personX, np.ndarray):
+                means[person_name] = features_mean_personX
+            else:
+                means[person_name] = None
+                logging.warning("Failed to extract features for %s. Skipping.", person_name)
+
+        enrolled = [name for name, mean in means.items() if mean is not None]
+        failed = [name for name, mean in means.items() if mean is None]
+        if failed:
+            gallery.remove_many(failed)
+        if enrolled:
+            gallery.upsert_many(enrolled, np.stack([means[name] for name in enrolled]))
+        return gallery
+
+    #  Folders holding the images of user_id, from the user registry
+    def person_folders(self, user_id):
+        folder = get_registry().folder(user_id)
+        if folder is None or not os.path.isdir(folder):
+            return []
+        return [os.path.basename(os.path.normpath(folder))]
+
+    #  Refresh the gallery row of user_id only
     def main(self, user_id):
         logging.basicConfig(level=logging.INFO)
-        person_list = os.listdir("data/data_faces_from_camera/")
+        self.export_people(self.person_folders(user_id))
+        logging.info("Save the features of %s into the gallery", user_id)
+
+    #  Rebuild the gallery from every registered person, e.g. after migrating from
+    #  CSV exports. workers > 1 spreads the images over a process pool.
+    def export_all(self, workers=1):
+        logging.basicConfig(level=logging.INFO)
+        person_list = os.listdir(path_images_from_camera)
         person_list.sort()
 
-        with open(f"data/export/{user_id}.csv", "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
+        if workers > 1:
+            from parallel_enroll import ParallelEnrollment
+            people = {}
             for person in person_list:
-                print(person)
-                logging.info("%sperson_%s", path_images_from_camera, person)
-                features_mean_personX = self.return_features_mean_personX(path_images_from_camera + person)
-                person_name = None
-                # Check if features were successfully extracted
-                if features_mean_personX is not -1:
-                    if len(person.split('_', 2)) == 2:
-                        person_name = person
-                    else:
-                        person_name = person.split('_', 2)[-1]
-    
-                    print("Person name :", person_name)
-    
-                    # Ensure features_mean_personX is a NumPy array before inserting
-                    if isinstance(features_mean_personX, np.ndarray):
-                        features_mean_personX = np.insert(features_mean_personX, 0, person_name, axis=0)
-                    else:
-                        # Handle case where features_mean_personX is not an array (e.g., -1)
-                        # Initialize a new array with person_name and handle this case appropriately
-                        features_mean_personX = np.array([person_name] + [0]*128)  # Example initialization
-    
-                    writer.writerow(features_mean_personX)
-                else:
-                    print(f"Failed to extract features for {person_name}. Skipping.")
-    
-            print(f"Save all the features of faces registered into: data/{user_id}.csv")
-            logging.info(f"Save all the features of faces registered into: data/{user_id}.csv")
+                folder = path_images_from_camera + person
+                people.setdefault(self.person_name(person), []).extend(
+                    os.path.join(folder, photo) for photo in sorted(os.listdir(folder)))
+            gallery = ParallelEnrollment(workers, cache_path=self.descriptor_cache.path).enroll_people(people)
+        else:
+            gallery = self.export_people(person_list)
+        gallery.compact()
+        registry = get_registry()
+        registry.import_folders()
+        registry.sync_gallery_rows(gallery)
+        logging.info("Save all the features of faces registered into: %s", gallery.path)
+
+    #  Enroll freshly uploaded images, given as FaceImage objects that may not
+    #  be on disk yet. Only these go through the dlib models; images
+    #  stored earlier for the user are served from the descriptor cache.
+    def enroll(self, user_id, face_images):
+        items = []
+        digests = []
+        for face_image in face_images:
+            items.append((face_image.data, "<upload>", face_image))
+            digests.append(content_hash(face_image.data))
+
+        for person in self.person_folders(user_id):
+            for photo in os.listdir(path_images_from_camera + person):
+                with open(path_images_from_camera + person + "/" + photo, "rb") as f:
+                    data = f.read()
+                digest = content_hash(data)
+                if digest not in digests:
+                    items.append((data, photo, None))
+                    digests.append(digest)
+
+        # The new images are described together in one batched call
+        features_list = self.return_128d_features_batch(items, digests)
+        features_list = [features for features in features_list if isinstance(features, np.ndarray)]
+        # Written through the resident gallery, so the serving process sees it without a reload
+        gallery = get_resident_gallery().snapshot()
+        if features_list:
+            with metrics.timed("persistence", face_images[0].trace if face_images else None):
+                gallery = get_resident_gallery().upsert(user_id, np.array(features_list, dtype=np.float32).mean(axis=0))
+                # Registered here as well: the images may still be on their way to disk
+                registry = get_registry()
+                registry.register(user_id)
+                registry.set_enrolled(user_id, gallery.rows_for(user_id)[-1], len(features_list))
+        else:
+            logging.warning("Failed to extract features for %s. Skipping.", user_id)
+        return gallery
             
 
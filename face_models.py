@@ -0,0 +1,59 @@
+# Process-wide registry for the dlib models
+#
+# The landmark predictor and the ResNet descriptor model are loaded lazily,
+# exactly once per process, and shared by every caller. The frontal face
+# detector is cheap to build but not safe to share between threads, so every
+# thread gets its own instance.
+#
+# A prefork server (gunicorn --preload, etc.) should call preload() in the
+# master before forking so the workers inherit the loaded models through
+# copy-on-write pages instead of each loading its own copy.
+
+import threading
+import logging
+import dlib
+
+PATH_PREDICTOR = 'data/data_dlib/shape_predictor_68_face_landmarks.dat'
+PATH_FACE_RECO_MODEL = 'data/data_dlib/dlib_face_recognition_resnet_model_v1.dat'
+
+_lock = threading.Lock()
+_models = {}
+_local = threading.local()
+
+
+def _load(name, factory, path):
+    model = _models.get(name)
+    if model is None:
+        with _lock:
+            model = _models.get(name)
+            if model is None:
+                logging.info("Loading dlib model: %s", path)
+                model = factory(path)
+                _models[name] = model
+    return model
+
+
+#  Dlib landmark / Get face landmarks
+def get_predictor():
+    return _load('predictor', dlib.shape_predictor, PATH_PREDICTOR)
+
+
+#  Dlib Resnet / 128D face descriptor model
+def get_face_reco_model():
+    return _load('face_reco_model', dlib.face_recognition_model_v1, PATH_FACE_RECO_MODEL)
+
+
+#  Dlib frontal face detector, one instance per thread
+def get_detector():
+    detector = getattr(_local, 'detector', None)
+    if detector is None:
+        detector = dlib.get_frontal_face_detector()
+        _local.detector = detector
+    return detector
+
+
+#  Load every model up front, e.g. in a prefork master or a pool initializer
+def preload():
+    get_predictor()
+    get_face_reco_model()
+    get_detector()
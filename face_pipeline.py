@@ -0,0 +1,187 @@
+# Per-image processing pipeline
+#
+# A FaceImage carries one decoded image through every stage: the grayscale
+# and equalized variants, the detected face rectangles, the 68-point shapes
+# and the 128D descriptors. Each stage is computed lazily, at most once, and
+# reuses the results of the stages before it, so validation, landmarking and
+# descriptor computation all share a single HOG detection.
+#
+# HOG cost grows with pixel count, so detection runs on a copy whose longer
+# side is capped at max_detect_side; the rectangles are mapped back to full
+# resolution and landmarks and descriptors use the full-resolution pixels.
+# benchmarks/bench_detect_resolution.py measures the latency/recall trade-off.
+#
+# Stage timings go to the metrics histograms and to the request trace that
+# was current when the FaceImage was created.
+
+import os
+import time
+import numpy as np
+import cv2
+import dlib
+import face_models
+import metrics
+
+#  Default HOG upsampling; enrollment uses more to find smaller faces
+DETECT_UPSAMPLE = 0
+
+#  Longer side of the image the detector sees, 0 disables downscaling
+DETECT_MAX_SIDE = int(os.environ.get('DETECT_MAX_SIDE', '1024'))
+
+#  Images handed to one batched compute_face_descriptor call
+DESCRIPTOR_BATCH_SIZE = 32
+
+
+class FaceImage():
+
+    def __init__(self, img_rd, data=None, upsample=DETECT_UPSAMPLE, max_faces=None,
+                 max_detect_side=DETECT_MAX_SIDE):
+        #  Decoded BGR image and, when known, the encoded bytes it came from
+        self.img_rd = img_rd
+        self.data = data
+        self.upsample = upsample
+        #  Only the first max_faces detections get landmarks and descriptors
+        self.max_faces = max_faces
+
+        #  Detection resolution relative to img_rd (<= 1)
+        self.max_detect_side = max_detect_side
+        longer_side = max(img_rd.shape[:2])
+        if max_detect_side and longer_side > max_detect_side:
+            self.detect_scale = max_detect_side / float(longer_side)
+        else:
+            self.detect_scale = 1.0
+
+        self._gray = None
+        self._small_gray = None
+        self._preprocess_time = 0.0
+        self._equalized = None
+        self._faces = None
+        self._shapes = None
+        self._descriptors = None
+        #  metrics.Trace of the request this image belongs to, if any
+        self.trace = metrics.current_trace()
+
+    #  Decode encoded image bytes; returns None when they are not an image
+    @classmethod
+    def from_bytes(cls, data, upsample=DETECT_UPSAMPLE, max_faces=None, max_detect_side=DETECT_MAX_SIDE):
+        if not data:
+            return None
+        with metrics.timed("decode"):
+            img_rd = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img_rd is None:
+            return None
+        return cls(img_rd, data, upsample, max_faces, max_detect_side)
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.img_rd, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    #  Grayscale at detection resolution
+    @property
+    def small_gray(self):
+        if self._small_gray is None:
+            start = time.perf_counter()
+            gray = self.gray
+            if self.detect_scale < 1.0:
+                gray = cv2.resize(gray, None, fx=self.detect_scale, fy=self.detect_scale,
+                                  interpolation=cv2.INTER_AREA)
+            self._small_gray = gray
+            self._preprocess_time = time.perf_counter() - start
+        return self._small_gray
+
+    #  Equalized grayscale at detection resolution;
+    #  histogram equalization improves contrast for the detector
+    @property
+    def equalized(self):
+        if self._equalized is None:
+            small_gray = self.small_gray
+            start = time.perf_counter()
+            self._equalized = cv2.equalizeHist(small_gray)
+            # One preprocess sample per image: grayscale, resize and equalization
+            metrics.observe("preprocess", self._preprocess_time + time.perf_counter() - start, self.trace)
+        return self._equalized
+
+    #  Face rectangles in full-resolution coordinates, detected once on the equalized image
+    @property
+    def faces(self):
+        if self._faces is None:
+            equalized = self.equalized
+            with metrics.timed("detect", self.trace):
+                faces = face_models.get_detector()(equalized, self.upsample)
+                if self.detect_scale < 1.0:
+                    faces = self._rescale(faces, 1.0 / self.detect_scale)
+            self._faces = faces
+        return self._faces
+
+    #  Use face rectangles found elsewhere (e.g. by a tracker) instead of detecting
+    @faces.setter
+    def faces(self, faces):
+        self._faces = faces
+        self._shapes = None
+        self._descriptors = None
+
+    @staticmethod
+    def _rescale(faces, factor):
+        rescaled = dlib.rectangles()
+        for face in faces:
+            rescaled.append(dlib.rectangle(int(round(face.left() * factor)), int(round(face.top() * factor)),
+                                           int(round(face.right() * factor)), int(round(face.bottom() * factor))))
+        return rescaled
+
+    def has_face(self):
+        return len(self.faces) > 0
+
+    #  68-point landmarks for the detected faces, on the color image
+    @property
+    def shapes(self):
+        if self._shapes is None:
+            faces = list(self.faces)[:self.max_faces]
+            predictor = face_models.get_predictor()
+            with metrics.timed("landmarks", self.trace):
+                self._shapes = [predictor(self.img_rd, face) for face in faces]
+        return self._shapes
+
+    #  All landmarked faces of the image as one dlib.full_object_detections
+    def _shape_collection(self):
+        shapes = dlib.full_object_detections()
+        for shape in self.shapes:
+            shapes.append(shape)
+        return shapes
+
+    #  128D descriptors of the landmarked faces, shape (n_faces, 128);
+    #  every face of the image goes through the network in one call
+    @property
+    def descriptors(self):
+        if self._descriptors is None:
+            if self.shapes:
+                face_reco_model = face_models.get_face_reco_model()
+                with metrics.timed("descriptor", self.trace):
+                    vectors = face_reco_model.compute_face_descriptor(self.img_rd, self._shape_collection())
+            else:
+                vectors = []
+            self._descriptors = np.array(vectors, dtype=np.float64).reshape(-1, 128)
+        return self._descriptors
+
+
+#  Compute the descriptors of many images with batched network calls. Images
+#  without faces or with descriptors already computed are skipped. Returns the
+#  descriptor arrays in input order.
+def compute_descriptors_batch(face_images, batch_size=DESCRIPTOR_BATCH_SIZE):
+    pending = [face_image for face_image in face_images
+               if face_image._descriptors is None and face_image.shapes]
+    if pending:
+        face_reco_model = face_models.get_face_reco_model()
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            started = time.perf_counter()
+            vectors = face_reco_model.compute_face_descriptor(
+                [face_image.img_rd for face_image in batch],
+                [face_image._shape_collection() for face_image in batch])
+            # Every image of the batch waited for the whole call
+            elapsed = time.perf_counter() - started
+            for face_image, image_vectors in zip(batch, vectors):
+                metrics.observe("descriptor", elapsed, face_image.trace)
+                face_image._descriptors = np.array(image_vectors, dtype=np.float64).reshape(-1, 128)
+    return [face_image.descriptors for face_image in face_images]
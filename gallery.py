@@ -0,0 +1,519 @@
+# Binary embedding gallery
+#
+# The gallery replaces the per-user CSV exports with a single file holding
+# every enrolled person's mean 128D descriptor:
+#
+#   gallery.bin      64-byte header followed by a row-major float32 matrix
+#   gallery.bin.ids  id table, one user_id per line, line i labels row i
+#
+# Header layout (little endian): magic b"FCGL", uint16 version, uint16
+# reserved, uint32 dim, uint64 count, uint64 committed size of the id table,
+# 4 bytes padding, uint64 generation at offset 32, zero padding up to 64
+# bytes. The matrix is opened with np.memmap so loading costs one mmap() call
+# regardless of the gallery size.
+#
+# Appends write the new rows and ids first and bump the header last, so a
+# reader never sees a row without its id, and a crashed append is simply
+# truncated away by the next one. Removed rows are tombstoned by
+# filling them with NaN; compact() rewrites the file without them. Every
+# append, tombstone pass and compaction bumps the generation; compaction
+# bumps it in the replaced file too. Files written before the generation
+# existed read as generation 0.
+#
+# A serving process keeps one ResidentGallery per file. It is loaded once
+# and hands out immutable snapshots: enrolling or removing a user writes the
+# file and then swaps in a new snapshot derived from the current one (the
+# id list, row index and valid mask are copied, the matrix is re-mapped), so
+# readers match against whatever snapshot they picked up without a lock.
+# The matrix itself is the shared file mapping: a row tombstoned after a
+# snapshot was taken reads as NaN through it. Replacements commit the new row
+# before tombstoning the old one, so a reader that meets NaN rows asks
+# latest() and finds the user's current embedding there.
+#
+# Worker processes share the gallery through the file itself: the matrix is
+# a read-only MAP_SHARED mapping, so its pages sit in the page cache once no
+# matter how many workers attach. Each worker also maps the header page and
+# compares its generation with the one of its snapshot on every read, a
+# plain memory load. A worker re-attaches only when another process
+# published a change, reading just the ids appended since, and readers keep
+# the snapshot they have while it does.
+
+import os
+import mmap
+import struct
+import fcntl
+import threading
+import logging
+import numpy as np
+
+PATH_GALLERY = "data/gallery/gallery.bin"
+
+MAGIC = b"FCGL"
+VERSION = 1
+DIM = 128
+HEADER_SIZE = 64
+_HEADER = struct.Struct("<4sHHIQQ4xQ")
+#  Offset of the generation, 8-byte aligned so a reader never sees it half written
+GENERATION_OFFSET = 32
+_GENERATION = struct.Struct("<Q")
+
+
+class Gallery():
+
+    def __init__(self, path=PATH_GALLERY):
+        self.path = path
+        self.ids_path = path + ".ids"
+        self.dim = DIM
+        self.ids = []
+        self.matrix = np.empty((0, DIM), dtype=np.float32)
+        self._rows = {}
+        self._valid = np.zeros(0, dtype=bool)
+        #  Header generation and file inode this gallery was loaded from
+        self.generation = None
+        self.inode = None
+        self.ids_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._rows
+
+    @staticmethod
+    def _pack_header(dim, count, ids_size, generation=0):
+        return _HEADER.pack(MAGIC, VERSION, 0, dim, count, ids_size, generation).ljust(HEADER_SIZE, b"\0")
+
+    @staticmethod
+    def _unpack_header(data):
+        if len(data) < HEADER_SIZE:
+            raise ValueError("Gallery header is truncated")
+        magic, version, _, dim, count, ids_size, generation = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a gallery file (bad magic)")
+        if version != VERSION:
+            raise ValueError("Unsupported gallery version: %d" % version)
+        return dim, count, ids_size, generation
+
+    #  Map the gallery file; an absent file loads as an empty gallery
+    def load(self):
+        if not os.path.exists(self.path):
+            self.ids = []
+            self.matrix = np.empty((0, self.dim), dtype=np.float32)
+            self._rows = {}
+            self._valid = np.zeros(0, dtype=bool)
+            self.generation = None
+            self.inode = None
+            self.ids_size = 0
+            return self
+
+        with open(self.path, "rb") as f:
+            dim, count, ids_size, generation = self._unpack_header(f.read(HEADER_SIZE))
+            inode = os.fstat(f.fileno()).st_ino
+        self.dim = dim
+        self.generation = generation
+        self.inode = inode
+        self.ids_size = ids_size
+
+        with open(self.ids_path, "rb") as f:
+            ids = f.read(ids_size).decode("utf-8").splitlines()
+        if len(ids) != count:
+            raise ValueError("Gallery id table has %d entries, header says %d" % (len(ids), count))
+
+        self.matrix = self._map(count)
+        self.ids = ids
+
+        # Index live rows by id; tombstoned rows are NaN
+        valid = np.isfinite(self.matrix[:, 0]) if count else np.zeros(0, dtype=bool)
+        valid.flags.writeable = False
+        self._valid = valid
+        self._rows = {}
+        for row, user_id in enumerate(ids):
+            if valid[row]:
+                self._rows.setdefault(user_id, []).append(row)
+        logging.info("Faces in gallery: %d", len(self._rows))
+        return self
+
+    #  Read-only view of the first count committed rows
+    def _map(self, count):
+        if not count:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", offset=HEADER_SIZE, shape=(count, self.dim))
+
+    #  True for every row that is not tombstoned (read-only)
+    def valid_mask(self):
+        return self._valid
+
+    #  Row indices holding the live embeddings of user_id
+    def rows_for(self, user_id):
+        return self._rows.get(user_id, [])
+
+    #  Live embeddings of user_id, shape (n_rows, dim); only these pages are touched
+    def embeddings_for(self, user_id):
+        rows = self.rows_for(user_id)
+        if not rows:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.asarray(self.matrix[rows], dtype=np.float32)
+
+    def _open_locked(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        while True:
+            # Not "a+b": append mode would send the header rewrite to the end of the file
+            f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # compact() may have replaced the file while we waited for the lock
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            f.write(self._pack_header(self.dim, 0, 0))
+            f.flush()
+            open(self.ids_path, "w").close()
+        return f
+
+    def append(self, ids, vectors):
+        vectors = self._checked(ids, vectors)
+        with self._lock, self._open_locked() as f:
+            self._append_locked(f, ids, vectors)
+        return self.load()
+
+    def _checked(self, ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(ids) != len(vectors):
+            raise ValueError("Got %d ids for %d vectors" % (len(ids), len(vectors)))
+        if any("\n" in i or "\r" in i for i in ids):
+            raise ValueError("Gallery ids must not contain line breaks")
+        return vectors
+
+    #  Append under the file lock held through f; returns the new generation
+    def _append_locked(self, f, ids, vectors):
+        f.seek(0)
+        dim, count, ids_size, generation = self._unpack_header(f.read(HEADER_SIZE))
+        if dim != self.dim:
+            raise ValueError("Gallery dim is %d, expected %d" % (dim, self.dim))
+
+        # Truncate anything past the committed rows (left over by an interrupted append)
+        end = HEADER_SIZE + count * dim * 4
+        f.truncate(end)
+        f.seek(end)
+        f.write(vectors.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+        new_ids = "".join(i + "\n" for i in ids).encode("utf-8")
+        with open(self.ids_path, "r+b") as ids_file:
+            ids_file.truncate(ids_size)
+            ids_file.seek(ids_size)
+            ids_file.write(new_ids)
+            ids_file.flush()
+            os.fsync(ids_file.fileno())
+
+        # Commit point: publish the new row count
+        f.seek(0)
+        f.write(self._pack_header(dim, count + len(vectors), ids_size + len(new_ids), generation + 1))
+        f.flush()
+        os.fsync(f.fileno())
+        return generation + 1
+
+    #  Tombstone every row of user_id in place; returns the number of rows removed
+    def remove(self, user_id):
+        return self.remove_many([user_id])
+
+    def remove_many(self, user_ids):
+        return self._update(user_ids, [], [])
+
+    #  Tombstone the rows of removed_ids and append (ids, vectors) in one file
+    #  lock, with the rows looked up under that lock; returns the rows removed
+    def _update(self, removed_ids, ids, vectors):
+        vectors = self._checked(ids, vectors)
+        with self._lock, self._open_locked() as f:
+            self.load()
+            rows = [row for user_id in removed_ids for row in self.rows_for(user_id)]
+            self._replace_locked(f, rows, ids, vectors)
+        self.load()
+        return len(rows)
+
+    #  Append (ids, vectors), then tombstone rows, with the file lock held; the
+    #  new rows are committed first so other processes never see a replaced
+    #  user missing. Returns the new generation, None when nothing changed.
+    def _replace_locked(self, f, rows, ids, vectors):
+        generation = None
+        if len(ids):
+            generation = self._append_locked(f, ids, vectors)
+        if rows:
+            generation = self._tombstone_locked(f, rows)
+        return generation
+
+    #  NaN-fill rows under the file lock held through f; returns the new generation
+    def _tombstone_locked(self, f, rows):
+        matrix = np.memmap(self.path, dtype=np.float32, mode="r+",
+                           offset=HEADER_SIZE, shape=(max(rows) + 1, self.dim))
+        matrix[rows] = np.nan
+        matrix.flush()
+        del matrix
+        return self._bump_generation(f)
+
+    #  Publish a change that did not touch the header fields, with the file lock held
+    def _bump_generation(self, f):
+        f.seek(0)
+        dim, count, ids_size, generation = self._unpack_header(f.read(HEADER_SIZE))
+        f.seek(0)
+        f.write(self._pack_header(dim, count, ids_size, generation + 1))
+        f.flush()
+        os.fsync(f.fileno())
+        return generation + 1
+
+    #  New gallery equal to this one after removing the rows of removed_ids and
+    #  appending ids at row len(self), as published under generation; self is
+    #  not modified
+    def _derive(self, removed_ids, ids, generation):
+        derived = Gallery(self.path)
+        derived.dim = self.dim
+        derived.generation = generation
+        derived.inode = self.inode
+        derived.ids_size = self.ids_size + sum(len(i.encode("utf-8")) + 1 for i in ids)
+        derived.ids = self.ids + list(ids)
+        derived.matrix = derived._map(len(derived.ids))
+
+        rows = dict(self._rows)
+        valid = np.concatenate([self._valid, np.ones(len(ids), dtype=bool)])
+        for user_id in removed_ids:
+            valid[rows.pop(user_id, [])] = False
+        for row, user_id in enumerate(ids, len(self.ids)):
+            rows[user_id] = rows.get(user_id, []) + [row]
+        valid.flags.writeable = False
+        derived._rows = rows
+        derived._valid = valid
+        return derived
+
+    #  New gallery holding what other processes committed to the same file
+    #  since this one was loaded. The file is append-only until compacted, so
+    #  only the ids past ids_size are decoded; the valid mask is rescanned to
+    #  pick up tombstones. A replaced (compacted) file is loaded in full.
+    def _refreshed(self):
+        with open(self.path, "rb") as f:
+            dim, count, ids_size, generation = self._unpack_header(f.read(HEADER_SIZE))
+            inode = os.fstat(f.fileno()).st_ino
+        if inode != self.inode or count < len(self.ids) or ids_size < self.ids_size:
+            return Gallery(self.path).load()
+
+        with open(self.ids_path, "rb") as f:
+            f.seek(self.ids_size)
+            new_ids = f.read(ids_size - self.ids_size).decode("utf-8").splitlines()
+        if len(new_ids) != count - len(self.ids):
+            raise ValueError("Gallery id table has %d new entries, header says %d"
+                             % (len(new_ids), count - len(self.ids)))
+
+        refreshed = Gallery(self.path)
+        refreshed.dim = dim
+        refreshed.generation = generation
+        refreshed.inode = inode
+        refreshed.ids_size = ids_size
+        refreshed.ids = self.ids + new_ids
+        refreshed.matrix = refreshed._map(count)
+        valid = np.isfinite(refreshed.matrix[:, 0]) if count else np.zeros(0, dtype=bool)
+        valid.flags.writeable = False
+
+        rows = dict(self._rows)
+        for row in np.flatnonzero(self._valid & ~valid[:len(self.ids)]).tolist():
+            user_id = self.ids[row]
+            live = [r for r in rows.get(user_id, []) if r != row]
+            if live:
+                rows[user_id] = live
+            else:
+                rows.pop(user_id, None)
+        for row in (np.flatnonzero(valid[len(self.ids):]) + len(self.ids)).tolist():
+            user_id = refreshed.ids[row]
+            rows[user_id] = rows.get(user_id, []) + [row]
+        refreshed._rows = rows
+        refreshed._valid = valid
+        return refreshed
+
+    #  Replace the embedding(s) of user_id with a single new one
+    def upsert(self, user_id, vector):
+        return self.upsert_many([user_id], [vector])
+
+    #  Replace the embeddings of many users with one tombstone pass and one append
+    def upsert_many(self, user_ids, vectors):
+        self._update(user_ids, user_ids, vectors)
+        return self
+
+    #  Rewrite the gallery without tombstoned rows
+    def compact(self):
+        temp_path = self.path + ".tmp"
+        with self._lock, self._open_locked() as old:
+            # Loaded under the file lock, so no append or tombstone can slip in before the rewrite
+            self.load()
+            valid = self.valid_mask()
+            if valid.all():
+                return self
+            ids = [i for i, keep in zip(self.ids, valid) if keep]
+            vectors = np.array(self.matrix[valid], dtype=np.float32)
+            ids_data = "".join(i + "\n" for i in ids).encode("utf-8")
+            generation = self.generation + 1
+            with open(temp_path, "wb") as f:
+                f.write(self._pack_header(self.dim, len(ids), len(ids_data), generation))
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_path + ".tmp", "wb") as f:
+                f.write(ids_data)
+                f.flush()
+                os.fsync(f.fileno())
+            # A crash between the two renames leaves a count mismatch that load() reports
+            os.replace(self.ids_path + ".tmp", self.ids_path)
+            os.replace(temp_path, self.path)
+            # After the rename, so workers that see the bump find the new file
+            self._bump_generation(old)
+        return self.load()
+
+
+#  Gallery loaded once and kept up to date in place; snapshot() is lock-free
+class ResidentGallery():
+
+    def __init__(self, path=PATH_GALLERY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._header = None
+        self._header_inode = None
+        self.reloads = 0
+        self.updates = 0
+
+    #  Current immutable gallery. Never modified after it is returned; changes
+    #  replace it with a new one. Only the very first call waits for a load:
+    #  afterwards one reader re-attaches while the others, and readers arriving
+    #  during an in-process update, keep using the snapshot they have.
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                self._reload_if_changed()
+                return self._snapshot
+        if self._current(snapshot) or not self._lock.acquire(blocking=False):
+            return snapshot
+        try:
+            self._reload_if_changed()
+        except ValueError:
+            # E.g. caught between the two renames of compact(); retried on the next read
+            logging.warning("Gallery %s changed while re-attaching, keeping generation %s",
+                            self.path, snapshot.generation, exc_info=True)
+        finally:
+            self._lock.release()
+        return self._snapshot
+
+    #  snapshot(), but waiting for a re-attach in progress; for readers that
+    #  found rows of their snapshot tombstoned
+    def latest(self):
+        with self._lock:
+            self._reload_if_changed()
+            return self._snapshot
+
+    #  Whether snapshot still matches the file; a memory read of the mapped header
+    def _current(self, snapshot):
+        header = self._header
+        if header is None:
+            return not os.path.exists(self.path)
+        return _GENERATION.unpack_from(header, GENERATION_OFFSET)[0] == snapshot.generation
+
+    #  Read-only mapping of the header page and the inode it belongs to
+    def _map_header(self):
+        try:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                # A file being created has no header yet; touching the mapping would fault
+                if st.st_size < HEADER_SIZE:
+                    return None, None
+                return mmap.mmap(f.fileno(), HEADER_SIZE, access=mmap.ACCESS_READ), st.st_ino
+        except FileNotFoundError:
+            return None, None
+
+    #  Re-attach if another process published a change, with self._lock held
+    def _reload_if_changed(self):
+        snapshot = self._snapshot
+        if snapshot is not None and self._current(snapshot):
+            return
+        if snapshot is not None and self._header is not None:
+            snapshot = snapshot._refreshed()
+        else:
+            snapshot = Gallery(self.path).load()
+        header = self._header
+        if self._header_inode != snapshot.inode:
+            # The header must belong to the file that was loaded: compaction swaps files in between
+            while True:
+                header, inode = self._map_header()
+                if inode == snapshot.inode:
+                    break
+                snapshot = Gallery(self.path).load()
+            self._header_inode = inode
+        # Replaced mappings are not closed, readers may still be looking at them
+        self._header = header
+        self._snapshot = snapshot
+        self.reloads += 1
+
+    #  Gallery.upsert_many applied to the file and to the resident copy; returns the new snapshot
+    def upsert(self, user_id, vector):
+        return self.upsert_many([user_id], [vector])
+
+    def upsert_many(self, user_ids, vectors):
+        return self._update(user_ids, user_ids, vectors)[0]
+
+    #  Tombstone every row of user_id; returns the number of rows removed
+    def remove(self, user_id):
+        return self.remove_many([user_id])
+
+    def remove_many(self, user_ids):
+        return self._update(user_ids, [], [])[1]
+
+    #  Tombstone the rows of removed_ids and append (ids, vectors) in one file
+    #  lock; returns (new snapshot, number of rows removed)
+    def _update(self, removed_ids, ids, vectors):
+        writer = Gallery(self.path)
+        vectors = writer._checked(ids, vectors)
+
+        with self._lock, writer._open_locked() as f:
+            # Holding the file lock, so the snapshot matches the file from here on
+            self._reload_if_changed()
+            snapshot = self._snapshot
+            rows = [row for user_id in removed_ids for row in snapshot.rows_for(user_id)]
+            generation = writer._replace_locked(f, rows, ids, vectors)
+            if generation is None:
+                return snapshot, 0
+            self._snapshot = snapshot._derive(removed_ids, ids, generation)
+            self.updates += 1
+            return self._snapshot, len(rows)
+
+    def stats(self):
+        snapshot = self._snapshot if self._snapshot is not None else Gallery(self.path)
+        return {
+            'rows': len(snapshot),
+            'users': len(snapshot._rows),
+            'generation': snapshot.generation or 0,
+            'reloads': self.reloads,
+            'updates': self.updates,
+        }
+
+
+_gallery_lock = threading.Lock()
+_galleries = {}
+
+
+#  Process-wide resident gallery for path
+def get_resident_gallery(path=PATH_GALLERY):
+    resident = _galleries.get(path)
+    if resident is None:
+        with _gallery_lock:
+            resident = _galleries.get(path)
+            if resident is None:
+                resident = _galleries[path] = ResidentGallery(path)
+    return resident
+
+
+#  Current snapshot of the process-wide gallery; loaded once, then only
+#  re-attached when another process published a new generation
+def get_gallery(path=PATH_GALLERY):
+    return get_resident_gallery(path).snapshot()
@@ -1,57 +1,63 @@
 import os
 from werkzeug.utils import secure_filename
 import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from face_pipeline import FaceImage, DETECT_UPSAMPLE
+import metrics
+from registry import get_registry
+
+#  Disk writes that are not needed to answer the request run here; a single
+#  worker keeps folder creation for the same user serialized
+_background_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-writer")
 
 class libs():
-    
+
+    #  Read an uploaded FileStorage into memory and decode it; returns a FaceImage or None
+    def decode_image(self, image, upsample=DETECT_UPSAMPLE, max_faces=None):
+        return FaceImage.from_bytes(self.read_image(image), upsample, max_faces)
+
+    #  Read an uploaded FileStorage into memory
+    def read_image(self, image):
+        with metrics.timed("upload_read"):
+            return image.stream.read()
+
+    #  Save already read image bytes into the user's folder
     def save_images(self, folder, user_id, images):    
-        name = self.check_duplicate(user_id)
-        if name == False:
-            user_folder = folder + self.take_latest_count() + str(user_id)
-            os.makedirs(user_folder, exist_ok=True)
-        else:
-            user_folder = name
+        # Existing folder of the user, or a new one numbered by the registry
+        user_folder = get_registry().register(str(user_id), folder)
+        os.makedirs(user_folder, exist_ok=True)
         
-        image_index = 1
-        for image in images:
+        for data in images:
             filename = secure_filename(f"{uuid.uuid4().hex}.jpg")
-            # Save the image to a temporary file to get its size
-            temp_path = os.path.join(user_folder, filename)
-            print("Temp path :", temp_path)
-            
-            image.save(temp_path)
-                
-            # Get the size of the image file
-            file_size = os.path.getsize(temp_path)
-            file_size_kb = file_size / 1024
-
-            print(f"Image {image_index} size: {file_size_kb} KB")
-            image_index += 1
+            image_path = os.path.join(user_folder, filename)
+            with metrics.timed("persistence"):
+                with open(image_path, "wb") as f:
+                    f.write(data)
+            logging.debug("Saved %s (%.1f KB)", image_path, len(data) / 1024)
         
         return user_folder
-    
-    def take_latest_count(self,):
-        folder_path = "data/data_faces_from_camera/"  # Update this with the path to your folder
 
-        # Get the list of files in the folder
-        files = os.listdir(folder_path)
+    #  Same as save_images, off the request path; returns a Future of the folder
+    def save_images_async(self, folder, user_id, images):
+        return _background_writer.submit(self.save_images, folder, user_id, images)
 
-        return str(len(files) + 1) + "_"
+    #  Write a single image to path off the request path
+    def save_file_async(self, path, data):
+        def write():
+            with metrics.timed("persistence"):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+        return _background_writer.submit(write)
+    
+    #  "<n>_" prefix the next new folder would get; informational only,
+    #  registry.register() allocates the number atomically
+    def take_latest_count(self,):
+        return str(get_registry().next_number()) + "_"
     
+    #  Folder of an already registered user_id, or False
     def check_duplicate(self,user_id):
-        folder_path = "data/data_faces_from_camera/"  # Update this with the path to your folder
-        old_name = False
-        # Get the list of files in the folder
-        files = os.listdir(folder_path)
-        for file_name in files:
-            parts = file_name.split("_")
-            e_user_id = parts[2]
-            
-            
-            if e_user_id == user_id:
-                old_name = folder_path + file_name
-                break        
-        
-        return old_name
+        return get_registry().folder(user_id) or False
             
@@ -0,0 +1,101 @@
+# Vectorized gallery matching
+#
+# Scores one probe or a batch of probes against the whole gallery with a
+# single matrix product, using ||p - g||^2 = ||p||^2 + ||g||^2 - 2 p.g with the
+# gallery norms computed once up front. Tombstoned (NaN) and empty (all zero)
+# rows are masked out and never returned.
+
+import numpy as np
+
+
+class GalleryMatcher():
+
+    def __init__(self, ids, matrix, valid=None):
+        self.ids = list(ids)
+        self.matrix = matrix if matrix.dtype == np.float32 else np.asarray(matrix, dtype=np.float32)
+        if len(self.ids) != len(self.matrix):
+            raise ValueError("Got %d ids for %d gallery rows" % (len(self.ids), len(self.matrix)))
+
+        norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        if valid is None:
+            valid = np.isfinite(norms)
+        self.valid = valid & np.isfinite(norms) & (norms > 0)
+        self.norms = np.where(self.valid, norms, np.inf).astype(np.float32)
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    #  Squared distances, shape (n_probes, n_gallery); invalid rows are +inf
+    def squared_distances(self, probes):
+        probes = np.atleast_2d(np.asarray(probes, dtype=np.float32))
+        probe_norms = np.einsum("ij,ij->i", probes, probes)
+        d2 = probe_norms[:, None] + self.norms[None, :] - 2.0 * (probes @ self.matrix.T)
+        d2 = np.where(self.valid[None, :], d2, np.inf)
+        # Rounding can push a perfect match slightly below zero
+        return np.maximum(d2, 0.0, out=d2)
+
+    #  Top-k (user_id, distance) pairs per probe, nearest first.
+    #  A single 1-D probe returns one list, a 2-D batch returns a list per probe.
+    def search(self, probes, k=1):
+        probes = np.asarray(probes, dtype=np.float32)
+        single = probes.ndim == 1
+        k = min(k, len(self))
+        if k <= 0:
+            results = [[] for _ in range(len(np.atleast_2d(probes)))]
+            return results[0] if single else results
+
+        d2 = self.squared_distances(probes)
+        if k < d2.shape[1]:
+            top = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(d2.shape[1]), (d2.shape[0], 1))
+        top_d2 = np.take_along_axis(d2, top, axis=1)
+        order = np.argsort(top_d2, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_dist = np.sqrt(np.take_along_axis(top_d2, order, axis=1))
+
+        results = [[(self.ids[row], float(dist)) for row, dist in zip(rows, dists)]
+                   for rows, dists in zip(top, top_dist)]
+        return results[0] if single else results
+
+
+#  1:1 verification: compare probe(s) against the claimed user's own embeddings only.
+#  Returns (matched, distance) for the closest probe/embedding pair.
+def verify(probes, embeddings, threshold):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    probes = np.atleast_2d(np.asarray(probes, dtype=np.float32))
+    if not len(embeddings) or not len(probes):
+        return False, float("inf")
+    diff = probes[:, None, :] - embeddings[None, :, :]
+    distances = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+    # A NaN (tombstoned) row never matches
+    distance = float(np.where(np.isfinite(distances), distances, np.inf).min())
+    return distance < threshold, distance
+
+
+#  verify() for many (probes, embeddings) pairs with one matrix product over
+#  all probes and all claimed embeddings; returns [(matched, distance), ...]
+def verify_batch(probe_groups, embedding_groups, threshold):
+    probe_groups = [np.atleast_2d(np.asarray(p, dtype=np.float32)).reshape(-1, 128) for p in probe_groups]
+    embedding_groups = [np.asarray(e, dtype=np.float32).reshape(-1, 128) for e in embedding_groups]
+    probes = np.concatenate(probe_groups) if probe_groups else np.empty((0, 128), dtype=np.float32)
+    embeddings = np.concatenate(embedding_groups) if embedding_groups else np.empty((0, 128), dtype=np.float32)
+    if not len(probes) or not len(embeddings):
+        return [(False, float("inf")) for _ in probe_groups]
+
+    d2 = np.einsum("ij,ij->i", probes, probes)[:, None] + np.einsum("ij,ij->i", embeddings, embeddings)[None, :] \
+        - 2.0 * (probes @ embeddings.T)
+
+    results = []
+    p_start = e_start = 0
+    for p, e in zip(probe_groups, embedding_groups):
+        block = d2[p_start:p_start + len(p), e_start:e_start + len(e)]
+        p_start += len(p)
+        e_start += len(e)
+        block = block[np.isfinite(block)]
+        if not block.size:
+            results.append((False, float("inf")))
+            continue
+        distance = float(np.sqrt(max(block.min(), 0.0)))
+        results.append((distance < threshold, distance))
+    return results
@@ -0,0 +1,187 @@
+# Per-stage latency metrics
+#
+# Every pipeline stage (upload read, decode, preprocess, detect, landmarks,
+# descriptor, match, persistence) is timed into a latency histogram, and the
+# app counts requests and errors. render() writes everything in the
+# Prometheus text exposition format, which the app serves on /metrics.
+#
+# A Trace collects the stage timings of one request. The app opens one per
+# request; a FaceImage remembers the trace that was current when it was
+# created, so stages that run later on inference or batching threads are
+# still booked to the request they serve. The app logs each request's
+# breakdown at DEBUG level.
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+STAGES = ("upload_read", "decode", "preprocess", "detect", "landmarks", "descriptor", "match", "persistence")
+
+#  Histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram():
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    #  Prometheus sample lines for this histogram under name{labels}
+    def samples(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, _format(bound), cumulative))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels.rstrip(','), _format(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','), self.count))
+        return lines
+
+
+def _format(value):
+    return repr(float(value))
+
+
+def _labels(**labels):
+    return "".join('%s="%s",' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                   for key, value in sorted(labels.items()))
+
+
+class Registry():
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.requests = {}
+        self.request_latency = {}
+        self.errors = {}
+
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.request_latency.get(endpoint)
+            if histogram is None:
+                histogram = self.request_latency[endpoint] = Histogram()
+            histogram.observe(seconds)
+
+    def count_error(self, endpoint, kind):
+        with self._lock:
+            key = (endpoint, kind)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP face_stage_duration_seconds Time spent per pipeline stage.",
+                     "# TYPE face_stage_duration_seconds histogram"]
+            for stage in sorted(self.stages):
+                lines.extend(self.stages[stage].samples("face_stage_duration_seconds", _labels(stage=stage)))
+
+            lines += ["# HELP face_http_request_duration_seconds Request latency per endpoint.",
+                      "# TYPE face_http_request_duration_seconds histogram"]
+            for endpoint in sorted(self.request_latency):
+                lines.extend(self.request_latency[endpoint].samples("face_http_request_duration_seconds",
+                                                                    _labels(endpoint=endpoint)))
+
+            lines += ["# HELP face_http_requests_total Requests by endpoint, method and status.",
+                      "# TYPE face_http_requests_total counter"]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append("face_http_requests_total{%s} %d" % (
+                    _labels(endpoint=endpoint, method=method, status=status).rstrip(','), count))
+
+            lines += ["# HELP face_http_errors_total Failed requests by endpoint and error kind.",
+                      "# TYPE face_http_errors_total counter"]
+            for (endpoint, kind), count in sorted(self.errors.items()):
+                lines.append("face_http_errors_total{%s} %d" % (
+                    _labels(endpoint=endpoint, kind=kind).rstrip(','), count))
+        return "\n".join(lines) + "\n"
+
+
+#  Gauge lines for a dict of numbers, e.g. InferenceExecutor.stats()
+def render_gauges(prefix, values, help_text=""):
+    lines = []
+    for key in sorted(values):
+        value = values[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = "%s_%s" % (prefix, key)
+        lines += ["# HELP %s %s%s" % (name, help_text, key), "# TYPE %s gauge" % name,
+                  "%s %s" % (name, _format(value))]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+REGISTRY = Registry()
+
+
+#  Stage timings of one request
+class Trace():
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    #  "decode=1.2ms detect=35.0ms ..." in pipeline order
+    def summary(self):
+        order = [stage for stage in STAGES if stage in self.stages] + \
+                sorted(stage for stage in self.stages if stage not in STAGES)
+        return " ".join("%s=%.1fms" % (stage, self.stages[stage] * 1000.0) for stage in order)
+
+
+_current_trace = contextvars.ContextVar("face_trace", default=None)
+
+
+def start_trace():
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def end_trace():
+    _current_trace.set(None)
+
+
+#  Record seconds spent in stage, into the histogram and the given (or current) trace
+def observe(stage, seconds, trace=None):
+    REGISTRY.observe_stage(stage, seconds)
+    trace = trace if trace is not None else current_trace()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage, trace=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, trace)
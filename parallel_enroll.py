@@ -0,0 +1,122 @@
+# Parallel enrollment engine
+#
+# Spreads descriptor computation over a ProcessPoolExecutor. Every worker
+# loads the dlib models once, in its initializer, and then describes chunks of
+# images with the batched extraction path (descriptor cache included). Chunks
+# are mapped in submission order and people are merged into the gallery
+# sorted by user_id, so the resulting gallery does not depend on scheduling.
+#
+#   from parallel_enroll import ParallelEnrollment
+#   ParallelEnrollment(workers=16).enroll_people({"alice": [path, ...], ...})
+
+import os
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import face_models
+from descriptor_cache import PATH_DESCRIPTOR_CACHE
+from gallery import Gallery
+
+#  Worker processes used for enrollment, ENROLL_WORKERS overrides
+ENROLL_WORKERS = int(os.environ.get('ENROLL_WORKERS', os.cpu_count() or 1))
+
+#  Images sent to a worker per task
+CHUNK_SIZE = 16
+
+_worker_extraction = None
+
+
+def _init_worker(cache_path):
+    global _worker_extraction
+    from extraction_face_to_csv import extraction
+    face_models.preload()
+    _worker_extraction = extraction(cache_path)
+
+
+#  chunk: list of (key, source), source is an image path or the encoded bytes.
+#  Returns (key, float32 descriptor or None) in the same order.
+def _describe_chunk(chunk):
+    items = []
+    for key, source in chunk:
+        if isinstance(source, (bytes, bytearray)):
+            items.append((bytes(source), str(key), None))
+        else:
+            with open(source, "rb") as f:
+                items.append((f.read(), source, None))
+    features = _worker_extraction.return_128d_features_batch(items)
+    return [(key, np.asarray(f, dtype=np.float32) if isinstance(f, np.ndarray) else None)
+            for (key, _), f in zip(chunk, features)]
+
+
+class ParallelEnrollment():
+
+    def __init__(self, workers=ENROLL_WORKERS, chunk_size=CHUNK_SIZE, cache_path=PATH_DESCRIPTOR_CACHE):
+        self.workers = max(1, int(workers))
+        self.chunk_size = chunk_size
+        self.cache_path = cache_path
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #  The pool is started on first use and reused until close()
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self.cache_path,))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    #  Describe (key, source) pairs; returns {key: descriptor or None}
+    def describe(self, sources):
+        sources = list(sources)
+        chunks = [sources[i:i + self.chunk_size] for i in range(0, len(sources), self.chunk_size)]
+        if self.workers == 1:
+            if _worker_extraction is None or _worker_extraction.descriptor_cache.path != self.cache_path:
+                _init_worker(self.cache_path)
+            results = map(_describe_chunk, chunks)
+        else:
+            results = self._get_pool().map(_describe_chunk, chunks)
+
+        descriptors = {}
+        for chunk_result in results:
+            descriptors.update(chunk_result)
+        return descriptors
+
+    #  Mean descriptor per user of {user_id: [source, ...]}; users without any
+    #  detected face map to None
+    def describe_people(self, people):
+        sources = [((user_id, i), source)
+                   for user_id in sorted(people) for i, source in enumerate(people[user_id])]
+        descriptors = self.describe(sources)
+
+        means = {}
+        for user_id in sorted(people):
+            features = [descriptors[(user_id, i)] for i in range(len(people[user_id]))]
+            features = [f for f in features if f is not None]
+            means[user_id] = np.mean(features, axis=0, dtype=np.float32) if features else None
+        return means
+
+    #  Enroll {user_id: [source, ...]} and write every person with one gallery append
+    def enroll_people(self, people, gallery=None):
+        gallery = gallery if gallery is not None else Gallery()
+        means = self.describe_people(people)
+
+        enrolled = [user_id for user_id in sorted(means) if means[user_id] is not None]
+        failed = [user_id for user_id in sorted(means) if means[user_id] is None]
+        for user_id in failed:
+            logging.warning("Failed to extract features for %s. Skipping.", user_id)
+
+        if failed:
+            gallery.remove_many(failed)
+        if enrolled:
+            gallery.upsert_many(enrolled, np.stack([means[user_id] for user_id in enrolled]))
+        logging.info("Enrolled %d people with %d workers", len(enrolled), self.workers)
+        return gallery
@@ -0,0 +1,94 @@
+# Image quality gate
+#
+# Cheap checks that turn away unusable images before the expensive stages
+# run. check_image() looks at pixels only (no model): sharpness as the
+# variance of the Laplacian and exposure as mean brightness, both on the
+# detection-resolution grayscale a FaceImage computes anyway. check_faces()
+# runs after the HOG detection but before the 68-point landmarks and the
+# ResNet descriptor: no face, more faces than expected, or a face box too
+# small relative to the frame to give a reliable descriptor.
+#
+# A failed check raises ImageRejected with a machine-readable reason and the
+# measured value, so clients can tell "retake the photo" from "not matched".
+
+import os
+import cv2
+
+#  Variance of the Laplacian below which an image is too blurry
+MIN_SHARPNESS = float(os.environ.get('QUALITY_MIN_SHARPNESS', '40'))
+#  Mean brightness (0-255) outside this range is under/overexposed
+MIN_BRIGHTNESS = float(os.environ.get('QUALITY_MIN_BRIGHTNESS', '40'))
+MAX_BRIGHTNESS = float(os.environ.get('QUALITY_MAX_BRIGHTNESS', '220'))
+#  Face box width relative to the shorter side of the frame
+MIN_FACE_RATIO = float(os.environ.get('QUALITY_MIN_FACE_RATIO', '0.08'))
+
+BLURRY = "blurry"
+UNDEREXPOSED = "underexposed"
+OVEREXPOSED = "overexposed"
+NO_FACE = "no_face"
+MULTIPLE_FACES = "multiple_faces"
+FACE_TOO_SMALL = "face_too_small"
+
+_MESSAGES = {
+    BLURRY: "Image is too blurry",
+    UNDEREXPOSED: "Image is too dark",
+    OVEREXPOSED: "Image is too bright",
+    NO_FACE: "Face not detected",
+    MULTIPLE_FACES: "More than one face in the image",
+    FACE_TOO_SMALL: "Face is too small, move closer to the camera",
+}
+
+
+class ImageRejected(Exception):
+
+    def __init__(self, reason, value=None, limit=None):
+        super().__init__(_MESSAGES[reason])
+        self.reason = reason
+        #  Measured value and the limit it failed, when the check has one
+        self.value = value
+        self.limit = limit
+        #  Position of the image in a multi-image request, set by the caller
+        self.image = None
+
+    def to_dict(self):
+        return {
+            'reason': self.reason,
+            'message': str(self),
+            'value': self.value,
+            'limit': self.limit,
+            'image': self.image,
+        }
+
+
+#  Pixel checks, no model involved
+def check_image(face_image, min_sharpness=MIN_SHARPNESS, min_brightness=MIN_BRIGHTNESS,
+                max_brightness=MAX_BRIGHTNESS):
+    gray = face_image.small_gray
+    brightness = float(gray.mean())
+    if brightness < min_brightness:
+        raise ImageRejected(UNDEREXPOSED, brightness, min_brightness)
+    if brightness > max_brightness:
+        raise ImageRejected(OVEREXPOSED, brightness, max_brightness)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    if sharpness < min_sharpness:
+        raise ImageRejected(BLURRY, sharpness, min_sharpness)
+
+
+#  Checks on the detected face boxes; runs the HOG detection, nothing after it
+def check_faces(face_image, max_faces=1, min_face_ratio=MIN_FACE_RATIO):
+    faces = face_image.faces
+    if not len(faces):
+        raise ImageRejected(NO_FACE, 0, 1)
+    if max_faces is not None and len(faces) > max_faces:
+        raise ImageRejected(MULTIPLE_FACES, len(faces), max_faces)
+
+    frame_side = min(face_image.img_rd.shape[:2])
+    ratio = max(face.width() for face in faces) / float(frame_side)
+    if ratio < min_face_ratio:
+        raise ImageRejected(FACE_TOO_SMALL, ratio, min_face_ratio)
+
+
+def check(face_image, max_faces=1):
+    check_image(face_image)
+    check_faces(face_image, max_faces)
@@ -0,0 +1,188 @@
+# Persistent user registry
+#
+# One SQLite row per registered user replaces the directory scans that used
+# to find a user's folder: user_id (primary key) -> image folder, gallery row
+# and enrollment metadata. New users get their number from the AUTOINCREMENT
+# key inside a write transaction, so concurrent uploads can no longer pick
+# the same "person_<n>_" prefix the way len(os.listdir()) + 1 did.
+#
+# An empty registry is filled from the existing person folders the first
+# time it is opened, so installations that predate it keep their users.
+# Connections are per thread; WAL mode lets readers run alongside a writer.
+
+import os
+import sqlite3
+import datetime
+import threading
+import logging
+from contextlib import contextmanager
+
+PATH_REGISTRY = "data/registry.db"
+
+#  Where registered people keep their images
+PATH_FACES = "data/data_faces_from_camera/"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    gallery_row INTEGER,
+    images INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    enrolled_at TEXT
+);
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+#  "person_<n>_<user_id>" folder name -> user_id, as extraction.person_name
+def _person_name(person):
+    if len(person.split('_', 2)) == 2:
+        return person
+    return person.split('_', 2)[-1]
+
+
+#  Write transaction on an autocommit connection; taken up front so two
+#  writers never both read before either writes
+@contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class UserRegistry():
+
+    def __init__(self, path=PATH_REGISTRY, faces_root=PATH_FACES):
+        self.path = path
+        self.faces_root = faces_root
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(_SCHEMA)
+                    if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+                        self.import_folders(conn)
+                    self._initialized = True
+        return conn
+
+    #  Register every person folder under faces_root that is not known yet
+    def import_folders(self, conn=None):
+        conn = conn or self._connect()
+        if not os.path.isdir(self.faces_root):
+            return 0
+        now = _now()
+        persons = sorted(os.listdir(self.faces_root))
+        rows = [(_person_name(person), os.path.join(self.faces_root, person), now) for person in persons]
+        # New users are numbered after the highest existing "person_<n>_" folder
+        numbers = [int(person.split('_')[1]) for person in persons
+                   if len(person.split('_', 2)) == 3 and person.split('_')[1].isdigit()]
+        with _transaction(conn):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO users (user_id, folder, created_at) VALUES (?, ?, ?)", rows)
+            imported = conn.total_changes - before
+            if numbers:
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'users'", (max(numbers),))
+        if imported:
+            logging.info("Registered %d existing users from %s", imported, self.faces_root)
+        return imported
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    #  Registry row of user_id as a dict, or None
+    def get(self, user_id):
+        row = self._connect().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    #  Image folder of user_id, or None
+    def folder(self, user_id):
+        row = self._connect().execute("SELECT folder FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    #  Folder of user_id, registering the user first if needed. New folders are
+    #  prefix + "<n>_" + user_id with n allocated in the same transaction.
+    def register(self, user_id, prefix=PATH_FACES + "person_"):
+        conn = self._connect()
+        with _transaction(conn):
+            row = conn.execute("SELECT folder FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                return row[0]
+            cursor = conn.execute("INSERT INTO users (user_id, folder, created_at) VALUES (?, '', ?)",
+                                  (user_id, _now()))
+            folder = "%s%d_%s" % (prefix, cursor.lastrowid, user_id)
+            conn.execute("UPDATE users SET folder = ? WHERE id = ?", (folder, cursor.lastrowid))
+        return folder
+
+    #  Number the next new user will get; register() allocates it atomically
+    def next_number(self):
+        row = self._connect().execute("SELECT seq FROM sqlite_sequence WHERE name = 'users'").fetchone()
+        return (row[0] if row is not None else 0) + 1
+
+    #  Record a finished enrollment: gallery row and number of images used
+    def set_enrolled(self, user_id, gallery_row=None, images=None):
+        self.set_enrolled_many([(user_id, gallery_row, images)])
+
+    #  set_enrolled for [(user_id, gallery_row, images), ...] in one transaction
+    def set_enrolled_many(self, entries):
+        now = _now()
+        with _transaction(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE users SET gallery_row = ?, images = COALESCE(?, images), enrolled_at = ? WHERE user_id = ?",
+                [(gallery_row, images, now, user_id) for user_id, gallery_row, images in entries])
+
+    #  Refresh every gallery_row from a loaded gallery.Gallery, e.g. after compact()
+    def sync_gallery_rows(self, gallery):
+        rows = []
+        for row, user_id in enumerate(gallery.ids):
+            live = gallery.rows_for(user_id)
+            if live and live[-1] == row:
+                rows.append((row, user_id))
+        with _transaction(self._connect()) as conn:
+            conn.execute("UPDATE users SET gallery_row = NULL")
+            conn.executemany("UPDATE users SET gallery_row = ? WHERE user_id = ?", rows)
+
+    #  Forget user_id; returns its former row as a dict, or None
+    def delete(self, user_id):
+        with _transaction(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        return dict(row) if row is not None else None
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+#  Process-wide registry for path
+def get_registry(path=PATH_REGISTRY):
+    with _registries_lock:
+        registry = _registries.get(path)
+        if registry is None:
+            registry = _registries[path] = UserRegistry(path)
+        return registry
@@ -0,0 +1,91 @@
+# Verification result cache
+#
+# Clients retry /take_attendance with the very same bytes after a network
+# hiccup. The verdict of a submission is cached under (user_id, SHA-256 of
+# the image bytes, gallery version of the user) so a retry is answered
+# without decoding or inference.
+#
+# The gallery version is the inode of the gallery file the snapshot was
+# loaded from plus the rows holding the user's embeddings: re-enrolling a user appends a new row and compact()
+# replaces the file, so an entry can never outlive the enrollment it was
+# computed against, even when another process changed the gallery.
+# invalidate() additionally drops a user's entries right away. Entries also
+# expire after ttl seconds, and the least recently used go first when full.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+#  Cached verdicts and their lifetime in seconds, RESULT_CACHE_SIZE=0 disables the cache
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '10000'))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', '300'))
+
+
+#  Version of user_id's enrollment in a loaded gallery.Gallery
+def gallery_version(gallery, user_id):
+    return gallery.inode, tuple(gallery.rows_for(user_id))
+
+
+class ResultCache():
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_of = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    #  Cached result for key = (user_id, digest, version), or None
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._keys_of.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        del self._entries[key]
+        keys = self._keys_of.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_of[key[0]]
+
+    #  Forget every cached verdict of user_id
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in list(self._keys_of.get(user_id, ())):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,131 @@
+# Bounded inference executor for the Flask app
+#
+# CPU-heavy request stages (detection, landmarks, descriptors, matching) run
+# on a fixed pool of worker threads fed by a bounded queue. When the queue is
+# full, submit() fails straight away with Overloaded, which the app turns into
+# 503 + Retry-After, instead of letting requests pile up until clients time
+# out. Tasks that waited in the queue longer than max_wait are dropped the
+# same way: their client has most likely given up already.
+#
+# Exceptions listed in expected_errors (e.g. images rejected by the quality
+# gate) are normal request outcomes: they reach the caller without being
+# logged as failures.
+#
+# Each worker thread gets its own dlib detector through face_models, the
+# predictor and descriptor model are shared. Threads are started on first use
+# in every process, so an executor created before a prefork server forks
+# still works in the workers.
+
+import os
+import math
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+
+
+class Overloaded(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__("Server overloaded, retry in %d s" % retry_after)
+        self.retry_after = retry_after
+
+
+class InferenceExecutor():
+
+    def __init__(self, workers=4, queue_size=32, max_wait=10.0, expected_errors=()):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.expected_errors = tuple(expected_errors)
+
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._busy_time = 0.0
+        self._completed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._started = time.monotonic()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive fork(): start a fresh pool in this process
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, args=(self._queue,), name="inference-%d" % i,
+                                 daemon=True).start()
+            self._started = time.monotonic()
+            self._pid = os.getpid()
+
+    #  Seconds a client should wait before retrying, from the current backlog
+    def retry_after(self):
+        with self._lock:
+            mean_service = self._busy_time / self._completed if self._completed else 1.0
+        backlog = self._queue.qsize() + self.workers
+        return max(1, int(math.ceil(backlog * mean_service / self.workers)))
+
+    def submit(self, fn, *args, **kwargs):
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((future, time.monotonic(), fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise Overloaded(self.retry_after())
+        return future
+
+    #  submit() and wait for the result; raises Overloaded or the task's exception
+    def run(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _worker(self, tasks):
+        while True:
+            future, enqueued, fn, args, kwargs = tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() - enqueued > self.max_wait:
+                with self._lock:
+                    self._expired += 1
+                future.set_exception(Overloaded(self.retry_after()))
+                continue
+
+            with self._lock:
+                self._busy += 1
+            start = time.monotonic()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                if isinstance(e, self.expected_errors):
+                    logging.debug("Inference task rejected: %s", e)
+                else:
+                    logging.exception("Inference task failed")
+                future.set_exception(e)
+            finally:
+                elapsed = time.monotonic() - start
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_time += elapsed
+                    self._completed += 1
+
+    #  Queue depth and worker utilisation for monitoring
+    def stats(self):
+        with self._lock:
+            uptime = time.monotonic() - self._started
+            return {
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'utilisation': self._busy_time / (uptime * self.workers) if uptime > 0 else 0.0,
+            }
@@ -0,0 +1,207 @@
+# Centroid tracker for the video attendance mode
+#
+# Faces of consecutive frames are linked by the distance between their box
+# centroids: the full distance matrix is built with NumPy and the assignment
+# is solved optimally (Hungarian method), so two faces never take over the
+# same track. Pairs further apart than max_distance are never linked; an
+# unmatched face opens a new track and a track unmatched for more than
+# max_age frames is dropped. Track ids are never reused, so a track keeps the
+# name recognized for it until it disappears.
+#
+# KeyframeDetector cuts the detection cost itself: the HOG detector runs on
+# keyframes only, and in between every face box is followed by a
+# dlib.correlation_tracker, which costs a fraction of a detection.
+
+import itertools
+import numpy as np
+import dlib
+
+#  Centroids further apart than this (pixels) between two frames are different faces
+MAX_DISTANCE = 100.0
+#  Frames a track survives without a matching face
+MAX_AGE = 10
+#  Run the detector every this many frames, 1 detects on every frame
+KEYFRAME_INTERVAL = 10
+#  Re-detect as soon as a correlation tracker reports a lower peak-to-sidelobe ratio
+MIN_TRACK_CONFIDENCE = 7.0
+
+
+#  Minimum-cost assignment of rows to columns of a cost matrix (Hungarian
+#  method with potentials, O(n^2 m)); returns (rows, cols) like
+#  scipy.optimize.linear_sum_assignment
+def linear_sum_assignment(cost):
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.ndim != 2:
+        raise ValueError("cost must be a 2D matrix")
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # 1-based; column 0 is a virtual column holding the row being inserted
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+
+            j1 = int(np.argmin(np.where(free, minv[1:], np.inf))) + 1
+            delta = minv[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        # Flip the augmenting path
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:])
+    rows = p[cols + 1] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+class Track():
+
+    def __init__(self, track_id, centroid):
+        self.id = track_id
+        self.centroid = centroid
+        self.name = "unknown"
+        self.distance = float("inf")
+        #  Frames since the track was last matched
+        self.age = 0
+
+
+class CentroidTracker():
+
+    def __init__(self, max_distance=MAX_DISTANCE, max_age=MAX_AGE):
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.tracks = {}
+        #  Ids of the tracks opened by the last update()
+        self.new_tracks = []
+        self._next_id = itertools.count(1)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getitem__(self, track_id):
+        return self.tracks[track_id]
+
+    #  Link the centroids of a new frame to the current tracks; returns the
+    #  track id of every centroid, in order
+    def update(self, centroids):
+        centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        tracks = list(self.tracks.values())
+        track_ids = [None] * len(centroids)
+
+        if tracks and len(centroids):
+            previous = np.array([track.centroid for track in tracks])
+            distances = np.sqrt(((centroids[:, None, :] - previous[None, :, :]) ** 2).sum(axis=2))
+            # Gated pairs cost more than any set of real pairs, so the solver
+            # first maximises the number of real matches, then minimises distance
+            gated = distances > self.max_distance
+            cost = np.where(gated, distances.sum() + 1.0, distances)
+            for row, col in zip(*linear_sum_assignment(cost)):
+                if not gated[row, col]:
+                    track_ids[row] = tracks[col].id
+
+        matched = set(track_ids)
+        for track in tracks:
+            if track.id not in matched:
+                track.age += 1
+                if track.age > self.max_age:
+                    del self.tracks[track.id]
+
+        self.new_tracks = []
+        for i, centroid in enumerate(centroids):
+            if track_ids[i] is None:
+                track = Track(next(self._next_id), centroid)
+                self.tracks[track.id] = track
+                self.new_tracks.append(track.id)
+                track_ids[i] = track.id
+            else:
+                track = self.tracks[track_ids[i]]
+                track.centroid = centroid
+                track.age = 0
+        return track_ids
+
+    def reset(self):
+        self.tracks = {}
+        self.new_tracks = []
+
+
+#  Face boxes of a stream from keyframe detections and correlation tracking in between
+class KeyframeDetector():
+
+    def __init__(self, interval=KEYFRAME_INTERVAL, min_confidence=MIN_TRACK_CONFIDENCE):
+        self.interval = max(1, interval)
+        self.min_confidence = min_confidence
+        #  Whether the last frame was a keyframe, and the lowest tracker confidence on it
+        self.keyframe = True
+        self.confidence = float("inf")
+        self._trackers = []
+        self._since_keyframe = 0
+
+    #  Set face_image.faces from the detector on keyframes and from the
+    #  correlation trackers otherwise; returns the face rectangles
+    def update(self, face_image):
+        self.keyframe = self._since_keyframe + 1 >= self.interval or not self._trackers
+        if not self.keyframe:
+            faces = self._track(face_image)
+            self.keyframe = faces is None
+        if self.keyframe:
+            faces = self._detect(face_image)
+        else:
+            face_image.faces = faces
+        return faces
+
+    def _detect(self, face_image):
+        faces = face_image.faces
+        self._trackers = []
+        # With every frame a keyframe the trackers would never be used
+        if self.interval > 1:
+            for face in faces:
+                tracker = dlib.correlation_tracker()
+                tracker.start_track(face_image.gray, face)
+                self._trackers.append(tracker)
+        self._since_keyframe = 0
+        self.confidence = float("inf")
+        return faces
+
+    #  Tracked rectangles, or None when any tracker lost confidence
+    def _track(self, face_image):
+        height, width = face_image.gray.shape[:2]
+        faces = dlib.rectangles()
+        confidence = float("inf")
+        for tracker in self._trackers:
+            confidence = min(confidence, tracker.update(face_image.gray))
+            if confidence < self.min_confidence:
+                return None
+            pos = tracker.get_position()
+            faces.append(dlib.rectangle(max(0, int(round(pos.left()))), max(0, int(round(pos.top()))),
+                                        min(width - 1, int(round(pos.right()))),
+                                        min(height - 1, int(round(pos.bottom())))))
+        self._since_keyframe += 1
+        self.confidence = confidence
+        return faces